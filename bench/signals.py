@@ -0,0 +1,73 @@
+# AsyncSignalin dispatchin ja kuuntelijoiden lisäyksen/poiston hinta:
+#   python bench/signals.py [rounds]
+import asyncio
+import random
+import sys
+import time
+from fantsu.util import AsyncSignal
+
+# Vanha toteutus vertailuksi: lista ja gather jokaiselle kuuntelijalle
+class ListSignal:
+
+    def __init__(self):
+        self.listeners = []
+
+    def __call__(self, f):
+        self.listeners.append(f)
+
+    def __delitem__(self, f):
+        self.listeners.remove(f)
+
+    async def dispatch(self, *args, **kwargs):
+        return await asyncio.gather(*(l(*args, **kwargs) for l in self.listeners))
+
+class Listener:
+
+    def on_sync(self, value):
+        pass
+
+    async def on_async(self, value):
+        pass
+
+async def bench_dispatch(cls, n, rounds, method):
+    sig = cls()
+    for l in [Listener() for _ in range(n)]:
+        sig(getattr(l, method))
+
+    start = time.perf_counter()
+    for i in range(rounds):
+        await sig.dispatch(i)
+    return (time.perf_counter() - start) / rounds
+
+def bench_churn(cls, n):
+    sig = cls()
+    listeners = [Listener().on_async for _ in range(n)]
+
+    start = time.perf_counter()
+    for l in listeners:
+        sig(l)
+    random.shuffle(listeners)
+    for l in listeners:
+        del sig[l]
+    return (time.perf_counter() - start) / n
+
+def us(t):
+    return "%9.2f us" % (1e6*t)
+
+async def main(rounds=20):
+    print("%6s | %-25s | %-12s | %-25s" % ("n", "dispatch (async)", "sync", "add+remove / listener"))
+    print("%6s | %12s %12s | %12s | %12s %12s" % ("", "list", "AsyncSignal", "AsyncSignal",
+        "list", "AsyncSignal"))
+
+    for n in (1, 10, 100, 1000, 10000):
+        r = max(1, rounds * 1000 // max(n, 100))
+        print("%6d | %s %s | %s | %s %s" % (n,
+            us(await bench_dispatch(ListSignal, n, r, "on_async")),
+            us(await bench_dispatch(AsyncSignal, n, r, "on_async")),
+            us(await bench_dispatch(AsyncSignal, n, r, "on_sync")),
+            us(bench_churn(ListSignal, n)),
+            us(bench_churn(AsyncSignal, n))
+        ))
+
+if __name__ == "__main__":
+    asyncio.run(main(*map(int, sys.argv[1:])))
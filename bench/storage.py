@@ -0,0 +1,65 @@
+# Commit-latenssi eri tallennusprofiileilla bettauksen tilityskuormalla:
+#   python bench/storage.py [users] [bettors] [rounds]
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from sqlalchemy import bindparam
+import fantsu.db as model
+from fantsu.storage import storage_profiles, create_engine, read_pragmas
+
+def bench(profile, path, num_users, num_bettors, rounds):
+    engine = create_engine(path, profile)
+    model.Base.metadata.create_all(engine)
+    table = model.User.__table__
+
+    with engine.begin() as conn:
+        conn.execute(table.insert(), [{"id": "u%d" % i, "display_name": "User %d" % i,
+            "points": 100} for i in range(num_users)])
+
+    update = table.update()\
+            .where(table.c.id == bindparam("_id"))\
+            .values(points=bindparam("points"))
+
+    settle = []
+    for _ in range(rounds):
+        rows = [{"_id": "u%d" % i, "points": random.randrange(100, 10000)}
+                for i in random.sample(range(num_users), num_bettors)]
+        start = time.perf_counter()
+        with engine.begin() as conn:
+            conn.execute(update, rows)
+        settle.append(time.perf_counter() - start)
+
+    single = []
+    for i in range(rounds):
+        start = time.perf_counter()
+        with engine.begin() as conn:
+            conn.execute(table.insert(), {"id": "new%d" % i, "display_name": "New", "points": 100})
+        single.append(time.perf_counter() - start)
+
+    pragmas = read_pragmas(engine)
+    engine.dispose()
+    return settle, single, pragmas
+
+def fmt(samples):
+    samples = sorted(samples)
+    return "p50 %7.2f ms  p95 %7.2f ms" % (
+        1000*statistics.median(samples),
+        1000*samples[int(0.95*(len(samples)-1))]
+    )
+
+def main(num_users=5000, num_bettors=1000, rounds=50):
+    print("%d users, %d bettors per settlement, %d rounds" % (num_users, num_bettors, rounds))
+
+    for name in storage_profiles:
+        with tempfile.TemporaryDirectory() as tmp:
+            settle, single, pragmas = bench(name, os.path.join(tmp, "fantsu.db"),
+                    num_users, num_bettors, rounds)
+
+        print("%-8s settlement: %s | single insert: %s | %s" % (name, fmt(settle), fmt(single),
+            " ".join("%s=%s" % kv for kv in pragmas.items())))
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
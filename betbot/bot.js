@@ -65,9 +65,12 @@ class Api {
 
 class BetBot {
 
-	constructor(client, api){
+	constructor(client, api, batchDelay){
 		this.client = client;
 		this.api = api;
+		this.batchDelay = batchDelay;
+		this.pending = [];
+		this.flushTimer = null;
 	}
 
 	async startCountdown(eid, countdown){
@@ -87,15 +90,15 @@ class BetBot {
 		this.client.say(mes);
 	}
 
-	endCountdown(eid, bets){
+	endCountdown(eid, pool){
 		log("bot", `Countdown finished eid=${eid}`);
 
 		if(!this.match || !this.match.teams)
 			return;
 
 		const totalBets = {};
-		for(let b of bets)
-			totalBets[b.target] = (totalBets[b.target] || 0) + b.amount;
+		for(let t of pool.targets)
+			totalBets[t.target] = t.amount;
 
 		this.client.say(`Veikkausaika päättyi. Veikkaukset: ${this.match.teams.map(t =>
 			`${t.name}: ${totalBets[t.id]||0}`).join(", ")}.`);
@@ -118,7 +121,7 @@ class BetBot {
 		}
 	}
 
-	async placeBet(uid, name, target, amount, reply){
+	placeBet(uid, name, target, amount, reply){
 		if(!this.match || !this.match.teams){
 			reply(`${name} -> Ottelu ei ole käynnissä.`);
 			return;
@@ -134,25 +137,45 @@ class BetBot {
 
 		log("bot", `Trying to place bet for ${uid} (${name}) on ${target}, ${amount} points`);
 
-		const resp = await this.api.postBetbot("/betbot/place", {
-			data: {
+		this.pending.push({
+			bet: {
+				event_id: this.match.eid,
 				id: uid,
 				display_name: name,
-				target: this.match.teams[target].id,
+				target: team.id,
 				amount: amount
-			}
+			},
+			name,
+			reply
 		});
 
-		if(resp.status === "OK"){
-			log("bot", "Betting OK!");
+		if(!this.flushTimer)
+			this.flushTimer = setTimeout(() => this.flushBets(), this.batchDelay);
+	}
+
+	// Chatin veikkaukset kerätään hetken ajalta ja lähetetään yhdellä pyynnöllä
+	async flushBets(){
+		const pending = this.pending;
+		this.pending = [];
+		this.flushTimer = null;
+
+		let resp;
+
+		try{
+			resp = await this.api.postBetbot("/betbot/place_batch", {
+				data: {bets: pending.map(p => p.bet)}
+			});
+		}catch(e){
+			err("bot", `Failed to place ${pending.length} bets`);
 			return;
 		}
 
-		log("bot", "Failed to place bet");
-		console.log(resp);
+		log("bot", `Placed batch of ${pending.length} bets`);
 
-		if(resp.error)
-			reply(`${name} -> Virhe: ${resp.error}`);
+		resp.results.forEach((r, i) => {
+			if(r.error)
+				pending[i].reply(`${pending[i].name} -> Virhe: ${r.error}`);
+		});
 	}
 
 	async getPoints(uid, name, reply){
@@ -174,7 +197,7 @@ class BetBot {
 }
 
 export default function(client, opt){
-	const bot = new BetBot(client, new Api(opt));
+	const bot = new BetBot(client, new Api(opt), opt.batchDelay || 100);
 
 	listen(`${opt.fantsu.address}/betting/events`, {
 		open: () => log("fantsu", `Connected to fantsu on ${opt.fantsu.address}`),
@@ -184,8 +207,8 @@ export default function(client, opt){
 			bot.startCountdown(event_id, countdown);
 		},
 
-		"betting:countdown-end": ({event_id, bets}) => {
-			bot.endCountdown(event_id, bets);
+		"betting:countdown-end": ({event_id, pool}) => {
+			bot.endCountdown(event_id, pool);
 		},
 
 		"betting:end": ({event_id, bets, winner}) => {
@@ -2,10 +2,13 @@ import asyncio
 from time import time
 import collections
 import functools
+import zlib
 from aiohttp import web
 import fantsu.db as model
+import fantsu.settlement as settlement
 from fantsu.logging import logger
-from fantsu.util import lazy_signal, dispatch
+from fantsu.codec import loads, dumps, json_response, request_json
+from fantsu.util import lazy_signal, dispatch, AsyncJobQueue, RateLimiter
 
 class BettingError(Exception):
     pass
@@ -52,9 +55,18 @@ class Countdown:
 
 class BettingMatch:
 
-    def __init__(self, targets):
+    def __init__(self, targets, event=None):
         self.targets = targets
+        self.event = event
         self.bets = {}
+        # Juoksevat summat per kohde, päivitetään jokaisen betin lisäyksessä/poistossa
+        self.totals = dict.fromkeys(targets, 0)
+        self.bettors = dict.fromkeys(targets, 0)
+        self.total_bet = 0
+        self.version = 0
+        # Ledgeristä palautettu matsi, jota ei vielä ole otettu käyttöön start():lla
+        self.restored = False
+        self.countdown_lock = asyncio.Lock()
         self._countdown = None
 
     def start_countdown(self, timeout):
@@ -102,10 +114,34 @@ class BettingMatch:
             logger.debug("Skipping 0 bet [uid=%s]" % user.id)
             return
 
+        if amount < 0:
+            raise BettingError("Trying to allocate negative points: %d" % amount)
+
+        old = self.bets.get(user.id)
+        if amount > user.points_available + (old.amount if old is not None else 0):
+            # Epäonnistunut betti ei saa poistaa vanhaa, ledgerissä se on yhä voimassa
+            raise BettingError("Trying to allocate %d points but only %d available" % (
+                amount, user.points_available + (old.amount if old is not None else 0)))
+
         self.remove_bet(user)
         user.allocate_points(amount)
         ret = Bet(user, target, amount)
         self.bets[user.id] = ret
+        self._tally(target, amount, 1)
+
+        return ret
+
+    def place_bets(self, bets, check_countdown=True):
+        if check_countdown and not self.countdown_active:
+            raise BettingError("Can't place a bet now")
+
+        ret = []
+
+        for user, target, amount in bets:
+            try:
+                ret.append(self.place_bet(user, target, amount, check_countdown=False))
+            except BettingError as e:
+                ret.append(e)
 
         return ret
 
@@ -116,58 +152,79 @@ class BettingMatch:
             return
 
         user.dealloc_points(bet.amount)
+        self._tally(bet.target, -bet.amount, -1)
         return bet
 
+    def pool(self, basebet=0):
+        pool = self.total_bet + basebet
+
+        return {
+            "total": pool,
+            "targets": [{
+                "target": t,
+                "amount": self.totals[t],
+                "bettors": self.bettors[t],
+                "odds": round(pool / self.totals[t], 2) if self.totals[t] else None
+            } for t in sorted(self.targets)]
+        }
+
+    def _tally(self, target, amount, bettors):
+        self.totals[target] += amount
+        self.bettors[target] += bettors
+        self.total_bet += amount
+        self.version += 1
+
     def cancel(self):
         self.cancel_countdown()
         while self.bets:
             self.remove_bet(next(iter(self.bets.values())).user)
 
     def finish(self, winner, basebet=0, min_points=0):
+        bets = list(self.bets.values())
+        amounts = settlement.asarray(b.amount for b in bets)
+
         if winner is None:
-            self._return_bets()
+            returns = amounts
         else:
-            self._calc_returns(basebet, winner)
-            self._distribute_points(min_points)
+            returns = self._calc_returns(bets, amounts, basebet, winner)
+
+        self._distribute_points(bets, amounts, returns, min_points)
 
         bets = self.bets
         # Ihan vaan siltä varalta ettei joku yritä käyttää tätä vahingossa
         self.bets = None
         return bets
 
-    def _return_bets(self):
-        for bet in self.bets.values():
-            bet.ret = bet.amount
+    def _calc_returns(self, bets, amounts, basebet, winner):
+        pool = self.total_bet + basebet
+        returns = settlement.settle(amounts, [b.target == winner for b in bets], pool)
+        logger.debug("Settled %d bets, pool %d" % (len(bets), pool))
+        return returns
 
-    def _calc_returns(self, basebet, winner):
-        total_bet = sum(b.amount for b in self.bets.values()) + basebet
-        total_win = sum(b.amount for b in self.bets.values() if b.target == winner)
+    def _distribute_points(self, bets, amounts, returns, min_points):
+        points = settlement.payout(settlement.asarray(b.user.points for b in bets),
+                amounts, returns, min_points=min_points)
 
-        for uid, bet in self.bets.items():
-            if bet.target == winner:
-                # jos tähän haaraan mennään niin välttämättä total_win>0
-                # XXX: roundin sijasta olis myös mahollista tallentaa pisteet floattina
-                bet.ret = round(total_bet * (bet.amount / total_win))
-            else:
-                bet.ret = 0
-
-            logger.debug("%s: %d => %d" % (bet.user, bet.amount, bet.ret))
-
-    def _distribute_points(self, min_points):
-        for bet in self.bets.values():
-            bet.user.dealloc_points(bet.amount)
-            bet.user.give_points(bet.ret - bet.amount, min_points=min_points)
+        for bet, p, ret in zip(bets, points.tolist(), returns.tolist()):
+            bet.ret = ret
+            bet.user.points_allocated -= bet.amount
+            bet.user.points = p
 
 # XXX: Tää luokka hoitaa nyt bettausten käsittelyn ja käyttäjän pistejutut
 # Tää pitäs jakaa kahteen luokkaan joista toinen hoitaa bettaukset/countdownit yms
 # ja toinen pitää kirjaa niistä beteistä ja käyttäjistä (esim. init_pointtien hoito)
 # TODO: on_tie ja rahat takasin kaikille cancelin sijasta
+#
+# Jokaisella eventillä on oma BettingMatch, joten rinnakkaisilla areenoilla voi
+# betata yhtä aikaa. Käyttäjän allokoidut pisteet ovat yhteiset kaikille matseille.
+# Jos event_id jätetään antamatta, käytetään ainoaa aktiivista matsia.
 class Betting:
 
     on_start = lazy_signal()
     on_countdown_start = lazy_signal()
     on_countdown_cancel = lazy_signal()
-    on_bet = lazy_signal()
+    # Taustajonossa ajettava, jumiutunut kuuntelija ei saa pysäyttää jonoa
+    on_bets = lazy_signal(timeout=5)
     on_countdown_end = lazy_signal()
     on_cancel = lazy_signal()
     on_end = lazy_signal()
@@ -177,122 +234,184 @@ class Betting:
         self.basebet = basebet
         self.min_points = min_points
         self.init_points = init_points or min_points
-        self._match = None
-        self._event = None
-        self._countdown_lock = asyncio.Lock()
+        self.matches = {}
+        self.coalesced = 0
+        self._notify = AsyncJobQueue()
+        self._pending_bets = {}
 
     @property
-    def match(self):
-        return self._match
+    def match_active(self):
+        return bool(self.matches)
 
-    @property
-    def event(self):
-        return self._event
+    def get_match(self, event_id=None):
+        if event_id is not None:
+            try:
+                return self.matches[event_id]
+            except KeyError:
+                raise BettingError("No match active on event %s" % event_id)
 
-    @property
-    def match_active(self):
-        return self._match is not None
+        if len(self.matches) > 1:
+            raise BettingError("Multiple matches active, event id required (one of: %s)" % (
+                list(self.matches)))
+
+        if not self.matches:
+            raise BettingError("No match active")
+
+        return next(iter(self.matches.values()))
 
     async def start(self, event, timeout=None):
-        if self.match_active:
-            #raise BettingError("Already have active match")
-            logger.error("Already have active, canceling it and force starting new match")
+        match = self.matches.get(event.id)
+
+        # Uudelleenkäynnistyksen jälkeen tuomari yhdistää uudestaan ja judging alkaa alusta.
+        # Palautettu matsi jatkuu sellaisenaan, betit ja countdown säilyvät.
+        if match is not None and match.restored:
+            match.restored = False
+            logger.info("Resuming restored match eid=%s with %d bets" % (event.id, len(match.bets)))
+            return
+
+        if match is not None:
+            logger.error("Already have active match on eid=%s, canceling it and force starting new match" % event.id)
             try:
-                await self.cancel()
+                await self.cancel(event.id)
             except:
-                logger.exception()
+                logger.exception("Failed to cancel match eid=%s" % event.id)
 
-        targets = set(event.team_ids)
-        self._match = BettingMatch(targets)
-        self._event = event
+        match = self.matches[event.id] = BettingMatch(set(event.team_ids), event)
         timeout = timeout or self.countdown_timeout
 
-        countdown = self._match.start_countdown(timeout)
+        countdown = match.start_countdown(timeout)
 
         logger.debug("Start betting on eid=%s" % event.id)
 
-        await dispatch(self, "on_start",
-                match=self._match,
-                event=self._event
-        )
+        await self._dispatch("on_start", match=match, event=event)
 
-        asyncio.ensure_future(self._run_countdown(countdown, match=self._match, event=self._event))
+        asyncio.ensure_future(self._run_countdown(countdown, match))
 
-    def restart_countdown(self, timeout=None):
-        self._check_match()
-        self._match.cancel_countdown()
+    def restart_countdown(self, timeout=None, event_id=None):
+        match = self.get_match(event_id)
+        match.cancel_countdown()
         timeout = timeout or self.countdown_timeout
-        asyncio.ensure_future(self._run_countdown(self._match.start_countdown(timeout),
-            match=self._match, event=self._event))
+        asyncio.ensure_future(self._run_countdown(match.start_countdown(timeout), match))
+
+    # Kaatumisen jälkeen ledgeristä, ei dispatchia
+    def restore(self, event, bets, countdown=None):
+        match = self.matches[event.id] = BettingMatch(set(event.team_ids), event)
+        match.restored = True
+
+        for (user, target, amount), ret in zip(bets, match.place_bets(bets, check_countdown=False)):
+            if isinstance(ret, BettingError):
+                logger.warning("Failed to restore bet of %s on eid=%s: %s" % (user, event.id, ret))
+
+        if countdown is not None and countdown > 0:
+            asyncio.ensure_future(self._run_countdown(match.start_countdown(countdown), match))
 
-    async def bet(self, user, target, amount):
-        self._check_match()
-        self._match.place_bet(user, target, amount)
+        logger.info("Restored match eid=%s with %d bets" % (event.id, len(match.bets)))
+        return match
+
+    def bet(self, user, target, amount, event_id=None):
+        match = self.get_match(event_id)
+        bet = match.place_bet(user, target, amount)
 
         logger.debug("User %s placed bet %d on target %s" % (user, amount, target))
 
-        await dispatch(self, "on_bet",
-            match=self._match,
-            event=self._event,
-            user=user,
-            target=target,
-            amount=amount
-        )
+        if bet is not None:
+            self._notify_bets(match, [bet])
 
-    async def cancel(self):
-        if not self.match_active:
-            return
+        return bet
 
-        self._match.cancel()
+    def bet_many(self, bets, event_id=None):
+        match = self.get_match(event_id)
+        ret = match.place_bets(bets)
+        placed = [b for b in ret if isinstance(b, Bet)]
 
-        logger.debug("Cancelled bet eid=%s" % self._event.id)
+        logger.debug("Placed %d/%d bets in batch eid=%s" % (len(placed), len(ret), match.event.id))
 
-        match = self._match
-        event = self._event
+        if placed:
+            self._notify_bets(match, placed)
 
-        self._match = None
-        self._event = None
+        return ret
 
-        await dispatch(self, "on_cancel", match=match, event=event)
+    # Betit hyväksytään heti, ilmoitukset (relay, ledger) kootaan taustajonoon.
+    # Saman käyttäjän uudempi betti samassa matsissa korvaa vielä lähettämättömän,
+    # joten ilmoitukseen päätyy vain viimeisin.
+    def _notify_bets(self, match, bets):
+        flush = not self._pending_bets
 
-    async def end(self, winner):
-        self._check_match()
+        for bet in bets:
+            key = match.event.id, bet.user.id
+            if self._pending_bets.pop(key, None) is not None:
+                self.coalesced += 1
+            self._pending_bets[key] = match, bet
 
-        if self._match.countdown_active:
-            self._match.cancel_countdown()
-            logger.warning("Match ended while countdown is still active")
+        if flush:
+            self._notify(self._flush_bets())
+
+    async def _flush_bets(self):
+        pending = self._pending_bets
+        self._pending_bets = {}
+
+        matches = collections.defaultdict(list)
+        for match, bet in pending.values():
+            matches[match].append(bet)
+
+        for match, bets in matches.items():
+            await dispatch(self, "on_bets", match=match, event=match.event, bets=bets)
+
+    async def cancel(self, event_id=None):
+        try:
+            match = self.get_match(event_id)
+        except BettingError:
+            return
 
-        bets = self._match.finish(winner=winner, basebet=self.basebet, min_points=self.min_points)
+        match.cancel()
+        del self.matches[match.event.id]
 
-        logger.debug("Finished bet eid=%s" % self._event.id)
+        logger.debug("Cancelled bet eid=%s" % match.event.id)
 
-        match = self._match
-        event = self._event
+        await self._dispatch("on_cancel", match=match, event=match.event)
 
-        self._match = None
-        self._event = None
+    async def end(self, winner, event_id=None):
+        match = self.get_match(event_id)
+
+        if match.countdown_active:
+            match.cancel_countdown()
+            logger.warning("Match ended while countdown is still active")
 
-        await dispatch(self, "on_end", match=match, event=event, bets=bets, winner=winner)
+        bets = match.finish(winner=winner, basebet=self.basebet, min_points=self.min_points)
+        del self.matches[match.event.id]
+
+        logger.debug("Finished bet eid=%s" % match.event.id)
+
+        await self._dispatch("on_end", match=match, event=match.event, bets=bets, winner=winner)
+        return bets
+
+    def pool(self, event_id=None):
+        match = self.get_match(event_id)
+        return dict(event_id=match.event.id, **match.pool(self.basebet))
 
     def reset_user(self, user):
         user.points = self.init_points
 
-    def _check_match(self):
-        if not self.match_active:
-            raise BettingError("No match active")
+    # Betit hyväksytään heti ja niiden on_bets ajetaan taustalla järjestyksessä.
+    # Muut signaalit odottavat jonon tyhjäksi, ettei esim. on_end ohita viimeisiä bettejä.
+    async def _dispatch(self, signame, **kwargs):
+        await self._notify.join()
+        await dispatch(self, signame, **kwargs)
+
+    async def _run_countdown(self, countdown_future, match):
+        event_kwargs = {"match": match, "event": match.event}
 
-    async def _run_countdown(self, countdown_future, **event_kwargs):
-        async with self._countdown_lock:
-            await dispatch(self, "on_countdown_start", **event_kwargs)
+        async with match.countdown_lock:
+            await self._dispatch("on_countdown_start", **event_kwargs)
 
             try:
                 await countdown_future
             except CountdownCancelled:
-                logger.debug("Countdown was cancelled eid")
-                await dispatch(self, "on_countdown_cancel", **event_kwargs)
+                logger.debug("Countdown was cancelled eid=%s" % match.event.id)
+                await self._dispatch("on_countdown_cancel", **event_kwargs)
             else:
-                logger.debug("Finished countdown eid=%s" % self._event.id)
-                await dispatch(self, "on_countdown_end", **event_kwargs)
+                logger.debug("Finished countdown eid=%s" % match.event.id)
+                await self._dispatch("on_countdown_end", **event_kwargs)
 
 def require_betbot(f):
     @functools.wraps(f)
@@ -304,25 +423,49 @@ def require_betbot(f):
         return await f(request)
     return ret
 
+def _rate_limited():
+    return json_response({"error": "too many requests"}, status=429)
+
+def _etag_response(request, body, etag):
+    if request.headers.get("If-None-Match") == etag:
+        return web.Response(status=304, headers={"ETag": etag})
+
+    return web.Response(text=body, content_type="application/json", headers={"ETag": etag})
+
+def _event_id(value):
+    return None if value is None else int(value)
+
 class BettingWebHandler:
 
-    def __init__(self, betting):
+    def __init__(self, betting, max_batch=5000, user_rate=None, user_burst=5, global_rate=None,
+            global_burst=100):
         self.betting = betting
-        self.db = None
+        self.max_batch = max_batch
+        self.user_limiter = RateLimiter(user_rate, user_burst)
+        self.global_limiter = RateLimiter(global_rate, global_burst)
+        self.stats = collections.Counter()
+        self.users = None
+        self._odds = {}
+        self._leaderboard = {}
 
-    def init(self, app, flt):
-        self.db = app["fantsu-db"]
+    def init(self, app, flts):
+        self.users = app["users"]
 
         app.add_routes([
             web.post("/betbot/place", require_betbot(self.handle_betbot_place)),
+            web.post("/betbot/place_batch", require_betbot(self.handle_betbot_place_batch)),
             web.post("/betbot/restart", require_betbot(self.handle_betbot_restart)),
-            web.get("/betting/user_points", self.get_points)
+            web.get("/betting/user_points", self.get_points),
+            web.get("/betting/leaderboard", self.get_leaderboard),
+            web.get("/betting/odds", self.get_odds),
+            web.get("/betting/stats", self.get_stats)
         ])
 
-        app["users"].on_create_user(self.create_user)
+        self.users.on_create_users(self.create_users)
 
-        flt.on_start(self.start_judging)
-        flt.on_end(self.end_judging)
+        for flt in flts:
+            flt.on_start(self.start_judging)
+            flt.on_end(self.end_judging)
 
     async def start_judging(self, ej, is_active):
         if not is_active:
@@ -334,7 +477,7 @@ class BettingWebHandler:
         if not is_active:
             return
 
-        if not self.betting.match_active:
+        if ej.event.id not in self.betting.matches:
             return
 
         # XXX: Tää oletaa xsumon, tän vois tehä yleisemminkin
@@ -348,57 +491,235 @@ class BettingWebHandler:
         else:
             winner = team1 if score1 > score2 else team2
 
-        await self.betting.end(winner)
-        self.db.commit()
+        bets = await self.betting.end(winner, event_id=ej.event.id)
+
+        # Tulokset pitää saada kantaan heti
+        self.users.mark_dirty_many(bet.user for bet in bets.values())
+        await self.users.flush()
+
+    def create_users(self, users):
+        for user in users:
+            self.betting.reset_user(user)
+
+    # Rajoitukset tarkistetaan ennen kantaa. Globaali raja jo ennen bodyn parsimista.
+    def _admit(self, key):
+        if not self.global_limiter.allow():
+            self.stats["rejected_global"] += 1
+            return False
 
-    async def create_user(self, user):
-        self.betting.reset_user(user)
+        return self._admit_user(key)
+
+    def _admit_user(self, key):
+        if not self.user_limiter.allow(key):
+            self.stats["rejected"] += 1
+            return False
+
+        self.stats["accepted"] += 1
+        return True
 
     async def handle_betbot_place(self, request):
-        data = await request.json()
+        if not self.global_limiter.allow():
+            self.stats["rejected_global"] += 1
+            return _rate_limited()
 
         try:
-            id = data["id"]
-            display_name = data["display_name"]
-            target = int(data["target"])
-            amount = int(data["amount"])
+            data = await request_json(request)
+            bet = (
+                data["id"],
+                data["display_name"],
+                _event_id(data.get("event_id", request.query.get("event_id"))),
+                int(data["target"]),
+                int(data["amount"])
+            )
         except:
-            return web.json_response({"error": "invalid request"}, status=400)
+            return json_response({"error": "invalid request"}, status=400)
+
+        if not self._admit_user(bet[0]):
+            return _rate_limited()
 
-        user = await request.app["users"].get_or_create(id, display_name)
+        id, display_name, event_id, target, amount = bet
+        user = await self.users.get_or_create(id, display_name)
 
         try:
-            await self.betting.bet(user, target, amount)
+            self.betting.bet(user, target, amount, event_id=event_id)
         except BettingError as e:
-            return web.json_response({"error": str(e)}, status=420)
+            return json_response({"error": str(e)}, status=420)
+
+        return json_response({"status": "OK"})
+
+    # Body on joko JSON-lista (tai {"bets": [...]}) tai application/x-ndjson, yksi betti
+    # per rivi. Vastauksessa tulos jokaiselle betille samassa järjestyksessä.
+    # Betin event_id voi antaa betissä tai koko batchille query stringissä.
+    async def handle_betbot_place_batch(self, request):
+        try:
+            batch = await self._read_batch(request)
+            default_event_id = _event_id(request.query.get("event_id"))
+        except:
+            return json_response({"error": "invalid request"}, status=400)
+
+        if len(batch) > self.max_batch:
+            return json_response({"error": "batch too large (max %d)" % self.max_batch},
+                    status=413)
+
+        results = [None] * len(batch)
+        bets = {}
+
+        for i, data in enumerate(batch):
+            try:
+                bet = (data["id"], data["display_name"],
+                        _event_id(data.get("event_id", default_event_id)),
+                        int(data["target"]), int(data["amount"]))
+            except:
+                results[i] = {"error": "invalid request"}
+                continue
+
+            if not self._admit_user(bet[0]):
+                results[i] = {"error": "too many requests"}
+                continue
+
+            bets[i] = bet
+
+        for i, ret in zip(bets, await self._place(list(bets.values()))):
+            results[i] = ret
+
+        return json_response({"status": "OK", "results": results})
+
+    # bets: [(id, display_name, event_id, target, amount)]
+    async def _place(self, bets):
+        results = [None] * len(bets)
+        users = await self.users.get_or_create_many((id, name) for id, name, *_ in bets)
+
+        matches = collections.defaultdict(list)
+        for i, (user, (_, _, event_id, target, amount)) in enumerate(zip(users, bets)):
+            matches[event_id].append((i, user, target, amount))
+
+        for event_id, match_bets in matches.items():
+            try:
+                placed = self.betting.bet_many([(user, target, amount)
+                    for _, user, target, amount in match_bets], event_id=event_id)
+            except BettingError as e:
+                placed = [e] * len(match_bets)
+
+            for (i, *_), ret in zip(match_bets, placed):
+                results[i] = {"error": str(ret)} if isinstance(ret, BettingError)\
+                        else {"status": "OK"}
+
+        return results
 
-        return web.json_response({"status": "OK"})
+    async def _read_batch(self, request):
+        if request.content_type != "application/x-ndjson":
+            data = await request_json(request)
+            return data["bets"] if isinstance(data, dict) else list(data)
+
+        ret = []
+
+        async for line in request.content:
+            line = line.strip()
+            if line:
+                ret.append(loads(line))
+                # ei lueta turhaan loppuun asti jos raja ylittyy
+                if len(ret) > self.max_batch:
+                    break
+
+        return ret
 
     async def handle_betbot_restart(self, request):
         try:
-            data = await request.json()
+            data = await request_json(request)
+        except:
+            data = {}
+
+        try:
             timeout = int(data["timeout"])
         except:
             timeout = None
 
         try:
-            await self.betting.restart_countdown(timeout=timeout)
+            event_id = _event_id(data.get("event_id", request.query.get("event_id")))
+        except ValueError:
+            return json_response({"error": "invalid request"}, status=400)
+
+        try:
+            self.betting.restart_countdown(timeout=timeout, event_id=event_id)
         except BettingError as e:
-            return web.json_response({"error": str(e)}, status=420)
+            return json_response({"error": str(e)}, status=420)
 
-        return web.json_response({"status": "OK"})
+        return json_response({"status": "OK"})
 
     async def get_points(self, request):
         try:
             id = request.query["id"]
             display_name = request.query["display_name"]
         except:
-            return web.json_response({"error": "invalid request"}, status=400)
+            return json_response({"error": "invalid request"}, status=400)
+
+        if not self._admit(("points", id)):
+            return _rate_limited()
 
-        user = await request.app["users"].get_or_create(id, display_name)
+        user = await self.users.get_or_create(id, display_name)
 
-        return web.json_response({
+        body = dumps({
             "total": user.points,
             "allocated": user.points_allocated,
-            "available": user.points_available
+            "available": user.points_available,
+            "rank": self.users.leaderboard.rank(user.id),
+            "users": len(self.users.leaderboard)
         })
+
+        return _etag_response(request, body, '"%08x"' % zlib.crc32(body.encode("utf-8")))
+
+    async def get_leaderboard(self, request):
+        try:
+            limit = max(1, min(int(request.query.get("limit", 10)), 1000))
+        except ValueError:
+            return json_response({"error": "invalid request"}, status=400)
+
+        leaderboard = self.users.leaderboard
+        cached = self._leaderboard.get(limit)
+
+        if cached is None or cached[0] != leaderboard.version:
+            body = dumps({
+                "users": len(leaderboard),
+                "top": [{
+                    "rank": rank,
+                    "display_name": self.users.get(id).display_name,
+                    "points": points
+                } for rank, id, points in leaderboard.top(limit)]
+            })
+
+            cached = self._leaderboard[limit] = leaderboard.version, body
+
+        return _etag_response(request, cached[1], '"%s-%d-%d"' % (leaderboard.epoch, cached[0],
+            limit))
+
+    async def get_stats(self, request):
+        return json_response(dict(self.stats, coalesced=self.betting.coalesced))
+
+    # Ilman event_id:tä kaikkien aktiivisten matsien potit listana
+    async def get_odds(self, request):
+        try:
+            event_id = _event_id(request.query.get("event_id"))
+        except ValueError:
+            return json_response({"error": "invalid request"}, status=400)
+
+        if event_id is None:
+            matches = list(self.betting.matches.values())
+        elif event_id in self.betting.matches:
+            matches = [self.betting.matches[event_id]]
+        else:
+            return json_response({"error": "No match active on event %s" % event_id},
+                    status=404)
+
+        version = [(m, m.version) for m in matches]
+        cached = self._odds.get(event_id)
+
+        if cached is None or cached[0] != version:
+            pools = [self.betting.pool(m.event.id) for m in matches]
+            body = dumps({"matches": pools} if event_id is None else pools[0])
+            cached = self._odds[event_id] = version, body
+
+            for k in list(self._odds):
+                if k is not None and k not in self.betting.matches:
+                    del self._odds[k]
+
+        return web.Response(text=cached[1], content_type="application/json")
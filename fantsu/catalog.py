@@ -0,0 +1,178 @@
+import asyncio
+import collections
+import os
+from sqlalchemy.orm import joinedload
+import robostat.db as model
+from robostat.web.views.api import jsonify
+from fantsu.logging import logger
+
+# Tietueet ovat muuttumattomia ja irti ORM:stä, joten niitä voi jakaa vapaasti
+# tuomarointien, filttereiden ja relayn kesken eikä niistä koskaan lähde kyselyjä kantaan
+class Record:
+
+    __slots__ = ()
+
+    def __init__(self, **values):
+        for k, v in values.items():
+            object.__setattr__(self, k, v)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%s is immutable" % type(self).__name__)
+
+    def __delattr__(self, name):
+        raise AttributeError("%s is immutable" % type(self).__name__)
+
+    def values(self):
+        return tuple(getattr(self, k) for k in self.__slots__)
+
+    def __repr__(self):
+        return "%s%s" % (type(self).__name__, self.values())
+
+class TeamRecord(Record):
+
+    __slots__ = ("id", "name", "school", "json")
+
+    def __init__(self, id, name, school, json):
+        super().__init__(id=id, name=name, school=school, json=json)
+
+    @classmethod
+    def from_orm(cls, team):
+        return cls(team.id, team.name, team.school, jsonify(team))
+
+class EventRecord(Record):
+
+    __slots__ = ("id", "block_id", "arena", "ts_sched", "teams", "team_ids")
+
+    def __init__(self, id, block_id, arena, ts_sched, teams):
+        teams = tuple(teams)
+        super().__init__(id=id, block_id=block_id, arena=arena, ts_sched=ts_sched,
+                teams=teams, team_ids=tuple(t.id for t in teams))
+
+    @classmethod
+    def from_orm(cls, event):
+        return cls(event.id, event.block_id, event.arena, event.ts_sched,
+                map(TeamRecord.from_orm, event.teams))
+
+    def values(self):
+        return self.id, self.block_id, self.arena, self.ts_sched,\
+                tuple(t.values() for t in self.teams)
+
+class JudgeRecord(Record):
+
+    __slots__ = ("id", "name")
+
+    def __init__(self, id, name):
+        super().__init__(id=id, name=name)
+
+    @classmethod
+    def from_orm(cls, judge):
+        return cls(judge.id, judge.name)
+
+def snapshot_event(event):
+    return event if isinstance(event, EventRecord) else EventRecord.from_orm(event)
+
+def snapshot_judge(judge):
+    return judge if isinstance(judge, JudgeRecord) else JudgeRecord.from_orm(judge)
+
+def load_catalog(db):
+    events = db.query(model.Event)\
+            .options(
+                    joinedload(model.Event.teams_part)
+                    .joinedload(model.EventTeam.team)
+            )\
+            .all()
+
+    return (
+        list(map(EventRecord.from_orm, events)),
+        list(map(JudgeRecord.from_orm, db.query(model.Judge).all())),
+        db.query(model.EventJudging.event_id, model.EventJudging.judge_id).all()
+    )
+
+# Robostatin turnausdata muistissa. Kanta on kisan aikana käytännössä muuttumaton,
+# joten se ladataan kerran ja päivitetään vain kun tiedosto muuttuu. Muuttuessa
+# ladataan koko kanta uudestaan (robostatin tauluista ei näe mitkä rivit muuttuivat),
+# mutta _merge pitää muuttumattomat tietueet ennallaan.
+class Catalog:
+
+    def __init__(self, db, path, poll_interval=5):
+        self.db = db
+        self.path = path
+        self.poll_interval = poll_interval
+        self.events = {}
+        self.judges = {}
+        self.events_by_judge = {}
+        self._mtime = None
+        self._refresh_lock = asyncio.Lock()
+        self._poller = None
+
+    def get_judging(self, event_id, judge_id):
+        if event_id not in self.events_by_judge.get(judge_id, ()):
+            return None, None
+
+        return self.events[event_id], self.judges[judge_id]
+
+    def start(self):
+        self._poller = asyncio.ensure_future(self._poll())
+
+    def stop(self):
+        if self._poller is not None:
+            self._poller.cancel()
+
+    async def refresh(self, force=False):
+        async with self._refresh_lock:
+            mtime = self._stat()
+            if not force and mtime == self._mtime:
+                return False
+
+            events, judges, judgings = await self.db.run(load_catalog)
+            self._mtime = mtime
+            self._update(events, judges, judgings)
+            return True
+
+    def _stat(self):
+        # WAL-tilassa muutokset näkyvät ensin -wal tiedostossa
+        ret = []
+        for path in (self.path, self.path + "-wal"):
+            try:
+                st = os.stat(path)
+                ret.append((st.st_mtime_ns, st.st_size))
+            except FileNotFoundError:
+                ret.append(None)
+        return tuple(ret)
+
+    def _update(self, events, judges, judgings):
+        # Muuttumattomat tietueet pidetään samoina olioina, niihin voi viitata muualta
+        self.events, changed_events = _merge(self.events, events)
+        self.judges, changed_judges = _merge(self.judges, judges)
+
+        events_by_judge = collections.defaultdict(set)
+        for event_id, judge_id in judgings:
+            events_by_judge[judge_id].add(event_id)
+        self.events_by_judge = {k: frozenset(v) for k,v in events_by_judge.items()}
+
+        logger.info("Catalog refreshed: %d events (%d changed), %d judges (%d changed), %d judgings"\
+                % (len(self.events), changed_events, len(self.judges), changed_judges,
+                    len(judgings)))
+
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+
+            try:
+                await self.refresh()
+            except Exception:
+                logger.exception("Failed to refresh catalog")
+
+def _merge(old, records):
+    ret = {}
+    changed = 0
+
+    for r in records:
+        o = old.get(r.id)
+        if o is not None and o.values() == r.values():
+            ret[r.id] = o
+        else:
+            ret[r.id] = r
+            changed += 1
+
+    return ret, changed
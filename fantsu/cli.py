@@ -12,10 +12,14 @@ import robostat.db
 import robostat.web.db
 from fantsu.flask_session import SessionDecoder
 from fantsu.db import Base
+from fantsu.storage import create_engine as create_fantsu_engine, check_pragmas
+from fantsu.robostat_db import RobostatDB
+from fantsu.catalog import Catalog
 from fantsu.users import UserManager
 from fantsu.judging import Judging, JudgingWebHandler
 from fantsu.filters import from_dict as flt_from_dict, from_list as flt_from_list, prio
 from fantsu.betting import Betting, BettingWebHandler
+from fantsu.ledger import BetLedger
 from fantsu.relay import init_relay
 from fantsu.logging import logger
 
@@ -78,7 +82,9 @@ def setup_db(app, config):
     rs_engine = sa.create_engine("sqlite:///%s" % rs_db_url)
 
     fantsu_db_url = config["FANTSU_DB"]
-    fantsu_engine = sa.create_engine("sqlite:///%s" % fantsu_db_url)
+    fantsu_profile = config.get("FANTSU_DB_PROFILE", "default")
+    fantsu_engine = create_fantsu_engine(fantsu_db_url, fantsu_profile)
+    check_pragmas(fantsu_engine, fantsu_profile)
 
     @listens_for(rs_engine, "connect")
     def configure_rs_engine(connection, record):
@@ -86,17 +92,41 @@ def setup_db(app, config):
         with contextlib.closing(connection.cursor()) as cursor:
             cursor.execute("PRAGMA query_only=1;")
 
-    @listens_for(fantsu_engine, "connect")
-    def configure_fantsu_engine(connection, record):
-        with contextlib.closing(connection.cursor()) as cursor:
-            cursor.execute("PRAGMA journal_model=WAL;")
-
     Base.metadata.create_all(fantsu_engine)
-    app["robostat-db"] = sessionmaker(bind=rs_engine)()
+
+    rs_db = RobostatDB(rs_engine, max_workers=config.get("FANTSU_ROBOSTAT_WORKERS", 4))
+    app["robostat-db"] = rs_db
+
+    catalog = Catalog(rs_db, rs_db_url, poll_interval=config.get("FANTSU_CATALOG_POLL", 5))
+    app["catalog"] = catalog
+
+    async def load_catalog(app):
+        await catalog.refresh(force=True)
+        catalog.start()
+    app.on_startup.append(load_catalog)
+
+    async def close_rs_db(app):
+        catalog.stop()
+        rs_db.close()
+    app.on_cleanup.append(close_rs_db)
+
     app["fantsu-db"] = sessionmaker(bind=fantsu_engine)()
 
 def setup_users(app, config):
-    app["users"] = UserManager(app)
+    users = UserManager(app,
+            flush_interval=config.get("FANTSU_USERS_FLUSH_INTERVAL", 1),
+            flush_size=config.get("FANTSU_USERS_FLUSH_SIZE", 100)
+    )
+    users.load()
+    app["users"] = users
+
+    async def start_users(app):
+        users.start()
+    app.on_startup.append(start_users)
+
+    async def close_users(app):
+        await users.close()
+    app.on_cleanup.append(close_users)
 
 def setup_judging(app, config):
     judging = Judging()
@@ -105,16 +135,30 @@ def setup_judging(app, config):
     app["judging"] = judging
 
 def setup_filters(app, config):
+    app["filter-opts"] = opts = {
+        "max_rate": config.get("FANTSU_FILTER_MAX_RATE", None),
+        "order": config.get("FANTSU_FILTER_ORDER", "ts_sched")
+    }
+
     if "FANTSU_FILTERS" not in config:
         return
 
     app["filters"] = {}
 
+    # Speksin dictissä voi antaa filtterikohtaisen max_raten, listaspeksi annetaan silloin
+    # filter-avaimessa: {"filter": [{...}, {...}], "max_rate": 2}
     for name, v in config["FANTSU_FILTERS"].items():
+        flt_opts = opts
+
+        if isinstance(v, dict) and "max_rate" in v:
+            v = dict(v)
+            flt_opts = dict(opts, max_rate=v.pop("max_rate"))
+            v = v.pop("filter", v)
+
         if isinstance(v, dict):
-            flt = prio(flt_from_dict(v))
+            flt = prio(flt_from_dict(v), **flt_opts)
         elif isinstance(v, list):
-            flt = flt_from_list(v)
+            flt = flt_from_list(v, **flt_opts)
         else:
             flt = v
 
@@ -127,6 +171,11 @@ def setup_betting(app, config):
     if "FANTSU_BETTING_FILTER" not in config:
         return
 
+    # Yksi filtteri per areena, jokaisen aktiivisella ottelulla oma bettaus
+    names = config["FANTSU_BETTING_FILTER"]
+    if isinstance(names, str):
+        names = [names]
+
     timeout = config.get("FANTSU_BETTING_COUNTDOWN", 60)
     basebet = config.get("FANTSU_BETTING_BASEBET", 100)
     min_points = config.get("FANTSU_BETTING_MIN_POINTS", 100)
@@ -134,11 +183,36 @@ def setup_betting(app, config):
     app["betting"] = betting
 
     app["betbot-token"] = config["FANTSU_BETBOT_TOKEN"]
-    flt = app["filters"][config["FANTSU_BETTING_FILTER"]]
-    handler = BettingWebHandler(betting)
-    handler.init(app, flt)
-
-    logger.info("Betting available on filter '%s'!" % config["FANTSU_BETTING_FILTER"])
+    flts = [app["filters"][name] for name in names]
+    handler = BettingWebHandler(betting,
+            max_batch=config.get("FANTSU_BETBOT_MAX_BATCH", 5000),
+            user_rate=config.get("FANTSU_BETBOT_USER_RATE", 1),
+            user_burst=config.get("FANTSU_BETBOT_USER_BURST", 3),
+            global_rate=config.get("FANTSU_BETBOT_GLOBAL_RATE", 200),
+            global_burst=config.get("FANTSU_BETBOT_GLOBAL_BURST", 400)
+    )
+    handler.init(app, flts)
+
+    ledger = BetLedger(app["users"])
+    ledger.attach(betting)
+
+    # Catalogin lataus on rekisteröity aiemmin, joten eventit ovat jo muistissa
+    async def restore_bets(app):
+        ledger.restore(betting, app["catalog"].events)
+    app.on_startup.append(restore_bets)
+
+    logger.info("Betting available on filters %s!" % names)
+
+def setup_relay(app, config):
+    init_relay(app,
+            queue_size=config.get("FANTSU_RELAY_QUEUE_SIZE", 256),
+            overflow=config.get("FANTSU_RELAY_OVERFLOW", "drop-oldest"),
+            delta_resync=config.get("FANTSU_RELAY_DELTA_RESYNC", 50),
+            pool_interval=config.get("FANTSU_RELAY_POOL_INTERVAL", 0.5),
+            history_size=config.get("FANTSU_RELAY_HISTORY_SIZE", 1024),
+            history_bytes=config.get("FANTSU_RELAY_HISTORY_BYTES", 1<<20),
+            linger=config.get("FANTSU_RELAY_LINGER", 30)
+    )
 
 def configure(app, config):
     setup_cookies(app, config)
@@ -147,8 +221,7 @@ def configure(app, config):
     setup_judging(app, config)
     setup_filters(app, config)
     setup_betting(app, config)
-
-    init_relay(app)
+    setup_relay(app, config)
 
 @click.command()
 @click.option("-c", "--config", required=True)
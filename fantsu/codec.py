@@ -0,0 +1,33 @@
+import json
+from aiohttp import web
+
+# orjson jos asennettu, muuten stdlib. dumps palauttaa aina kompaktin str:n.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    name = "orjson"
+
+    def loads(data):
+        return orjson.loads(data)
+
+    def dumps(data):
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+
+else:
+    name = "json"
+    _encoder = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False)
+
+    def loads(data):
+        return json.loads(data)
+
+    def dumps(data):
+        return _encoder.encode(data)
+
+def json_response(data, **kwargs):
+    return web.json_response(data, dumps=dumps, **kwargs)
+
+async def request_json(request):
+    return await request.json(loads=loads)
@@ -12,3 +12,17 @@ class User(betting_mixin.BettingUserMixin, Base):
 
     def __str__(self):
         return "%s (%s)" % (self.display_name, self.id)
+
+# Append-only loki bettauksista, ks. fantsu.ledger
+class BetLedgerEntry(Base):
+    __tablename__ = "bet_ledger"
+    __table_args__ = (sa.Index("bet_ledger_event", "event_id", "id"),)
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    ts = sa.Column(sa.Float, nullable=False)
+    event_id = sa.Column(sa.Integer, nullable=False)
+    op = sa.Column(sa.String, nullable=False)
+    user_id = sa.Column(sa.String)
+    target = sa.Column(sa.Integer)
+    amount = sa.Column(sa.Integer)
+    ret = sa.Column(sa.Integer)
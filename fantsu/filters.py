@@ -1,59 +1,192 @@
+import bisect
 from fantsu.judging import EventFilter
 
+# Predikaatit tietävät mihin arvoihin ne täsmäävät (index_keys), jolloin Judging
+# voi reitittää tuomaroinnit suoraan hashindeksin kautta kiinnostuneille filttereille.
+# index_keys palauttaa None jos predikaattia ei voi indeksoida.
+def index_keys(f):
+    return f.index_keys() if hasattr(f, "index_keys") else None
+
+orderings = {
+    "ts_sched": lambda ej, num: ej.event.ts_sched,
+    "start": lambda ej, num: num,
+    "arena": lambda ej, num: ej.event.arena
+}
+
+# Tuomaroinnit pidetään prioriteettitasoittain järjestetyissä listoissa, joita päivitetään
+# sitä mukaa kun tuomarointeja alkaa ja loppuu. Aktiivinen vaihtuu vain jos korkeammalle
+# tasolle tulee tuomarointi, saman tason sisällä ensimmäinen order-järjestyksessä voittaa.
 class PriorityFilter(EventFilter):
 
-    def __init__(self, *flts):
-        super().__init__()
+    def __init__(self, *flts, max_rate=None, order="ts_sched"):
+        if isinstance(order, str):
+            order = (order,)
+
+        try:
+            self._order = [orderings[o] for o in order]
+        except KeyError as e:
+            raise ValueError("Invalid order: %s (Expected one of: %s)" % (e, list(orderings)))
+
+        super().__init__(max_rate=max_rate)
         self._filters = flts
+        self._tiers = [[] for _ in flts]
+        self._keys = {}
+        self._num_added = 0
 
     def filter(self, ej):
         return any(f(ej) for f in self._filters)
 
+    def index_keys(self):
+        return _union_keys(self._filters)
+
     def select_active(self, ejs):
-        for f in self._filters:
-            if self.active is not None and f(self.active):
+        active_tier = self._keys[self.active][0] if self.active in self._keys else None
+
+        for i, tier in enumerate(self._tiers):
+            if i == active_tier:
                 return self.active
-            for ej in ejs:
-                if f(ej):
-                    return ej
+            if tier:
+                return tier[0][1]
+
+    def _add(self, ej):
+        super()._add(ej)
+
+        tier = next(i for i, f in enumerate(self._filters) if f(ej))
+        self._num_added += 1
+        # (event, judge) lopussa: avaimet ovat uniikkeja eikä tuomarointeja verrata koskaan
+        key = (*(o(ej, self._num_added) for o in self._order), ej.event.id, ej.judge.id)
+
+        self._keys[ej] = tier, key
+        bisect.insort(self._tiers[tier], (key, ej))
+
+    def _remove(self, ej):
+        super()._remove(ej)
+
+        i, key = self._keys.pop(ej)
+        tier = self._tiers[i]
+        del tier[bisect.bisect_left(tier, (key,))]
 
 prio = PriorityFilter
 
+class _Match:
+
+    def __init__(self, field, values):
+        self.field = field
+        self.values = frozenset(values)
+
+    def __call__(self, ej):
+        return ej.route_value(self.field) in self.values
+
+    def index_keys(self):
+        return {(self.field, v) for v in self.values}
+
+class _MatchTeam(_Match):
+
+    def __init__(self, values):
+        super().__init__("team", values)
+
+    def __call__(self, ej):
+        return not self.values.isdisjoint(ej.event.team_ids)
+
+class _Any:
+
+    def __init__(self, flts):
+        self.flts = flts
+
+    def __call__(self, ej):
+        return any(f(ej) for f in self.flts)
+
+    def index_keys(self):
+        return _union_keys(self.flts)
+
+class _All:
+
+    def __init__(self, flts):
+        self.flts = flts
+
+    def __call__(self, ej):
+        return all(f(ej) for f in self.flts)
+
+    def index_keys(self):
+        # Kaikkien pitää täsmätä, joten mikä tahansa indeksoitava osa kelpaa,
+        # valitaan niistä pienin
+        keys = [k for k in map(index_keys, self.flts) if k is not None]
+        return min(keys, key=len) if keys else None
+
+def _union_keys(flts):
+    ret = set()
+
+    for f in flts:
+        keys = index_keys(f)
+        if keys is None:
+            return None
+        ret.update(keys)
+
+    return ret
+
 def arena(*arenas):
-    arenas = set(arenas)
-    return lambda ej: ej.event.arena in arenas
+    return _Match("arena", arenas)
 
 def block(*blocks):
-    blocks = set(block)
-    return lambda ej: ej.event.block_id in blocks
+    return _Match("block", blocks)
 
 def team(*team_ids):
-    team_ids = set(team_ids)
-    return lambda ej: any(tid in team_ids for tid in ej.event.team_ids)
+    return _MatchTeam(team_ids)
 
 def judge(*judge_ids):
-    judge_ids = set(judge_ids)
-    return lambda ej: ej.judge.id in judge_ids
+    return _Match("judge", judge_ids)
 
 def any_(*flts):
-    return lambda ej: any(f(ej) for f in flts)
+    return _Any(flts)
 
 def all_(*flts):
-    return lambda ej: all(f(ej) for f in flts)
+    return _All(flts)
+
+def _values(v):
+    return v if isinstance(v, (list, tuple, set)) else [v]
 
 def from_dict(d):
     flts = []
 
     if "arena" in d:
-        flts.append(arena(d["arena"]))
+        flts.append(arena(*_values(d["arena"])))
     if "block" in d:
-        flts.append(block(d["block"]))
+        flts.append(block(*_values(d["block"])))
     if "team" in d:
-        flts.append(team(map(int, d["team"])))
+        flts.append(team(*map(int, _values(d["team"]))))
     if "judge" in d:
-        flts.append(judge(map(int, d["judge"])))
+        flts.append(judge(*map(int, _values(d["judge"]))))
 
     return any_(*flts)
 
-def from_list(l):
-    return prio(list(map(from_dict, l)))
+def from_list(l, **kwargs):
+    return prio(*map(from_dict, l), **kwargs)
+
+spec_keys = {
+    "arena": str,
+    "block": str,
+    "team": int,
+    "judge": int
+}
+
+# Kanoninen muoto from_dict/from_list-speksille, jotta samat speksit tunnistetaan samoiksi
+def normalize_spec(spec):
+    if isinstance(spec, dict):
+        spec = [spec]
+
+    if not isinstance(spec, list) or not spec:
+        raise ValueError("Invalid filter spec: %s" % spec)
+
+    ret = []
+
+    for d in spec:
+        if not isinstance(d, dict) or not d or not d.keys() <= spec_keys.keys():
+            raise ValueError("Invalid filter spec: %s (Expected keys: %s)" % (
+                d, list(spec_keys)))
+
+        try:
+            ret.append({k: sorted(set(map(spec_keys[k], _values(v)))) for k,v in d.items()})
+        except TypeError:
+            raise ValueError("Invalid filter spec: %s" % d)
+
+    return ret
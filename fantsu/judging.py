@@ -1,26 +1,49 @@
 import asyncio
+import collections
 import contextlib
 from datetime import datetime
 from aiohttp import web
-from sqlalchemy.orm import joinedload
 import itsdangerous
-import robostat.db as model
 from fantsu.logging import logger, request_logger
-from fantsu.util import lazy_signal, dispatch
+from fantsu.codec import loads, dumps, json_response
+from fantsu.catalog import snapshot_event, snapshot_judge
+from fantsu.util import lazy_signal, dispatch, AsyncJobQueue
 
 class JudgingError(Exception):
     pass
 
 class EventJudging:
 
+    __slots__ = ("event", "judge", "state", "state_raw", "__weakref__")
+
     def __init__(self, event, judge):
         self.event = event
         self.judge = judge
         self.state = None
+        # Tuomarilta tullut json sellaisenaan, jos se kelpaa suoraan relayhin
+        self.state_raw = None
 
     def __str__(self):
         return "(%d,%d) %s" % (self.event.id, self.judge.id, self.state)
 
+    def route_value(self, field):
+        if field == "arena":
+            return self.event.arena
+        if field == "block":
+            return self.event.block_id
+        if field == "judge":
+            return self.judge.id
+        raise KeyError(field)
+
+    def route_keys(self):
+        ret = [
+            ("arena", self.event.arena),
+            ("block", self.event.block_id),
+            ("judge", self.judge.id)
+        ]
+        ret.extend(("team", tid) for tid in self.event.team_ids)
+        return ret
+
 class EventFilter:
 
     on_start = lazy_signal()
@@ -28,26 +51,35 @@ class EventFilter:
     on_update = lazy_signal()
     on_end = lazy_signal()
 
-    def __init__(self):
+    def __init__(self, max_rate=None):
         self.active = None
         self.all = set()
+        self.max_rate = max_rate
         self._update_lock = asyncio.Lock()
+        self._last_update = {}
+        self._pending_update = {}
 
     def filter(self, ej):
         raise NotImplementedError
 
+    def index_keys(self):
+        return None
+
     def select_active(self, ejs):
         raise NotImplementedError
 
     def init(self, ejs):
-        self.all.update(filter(self.filter, ejs))
+        for ej in ejs:
+            if self.filter(ej):
+                self._add(ej)
+
         self._maybe_update_active()
 
     async def start(self, ej):
         if not self.filter(ej):
-            return
+            return False
 
-        self.all.add(ej)
+        self._add(ej)
         old_active, new_active = self._maybe_update_active()
 
         async with self._update_lock:
@@ -62,18 +94,52 @@ class EventFilter:
                         new_active=new_active
                 )
 
+        return True
+
     async def update(self, ej):
         if ej not in self.all:
             return
 
+        if self.max_rate is None:
+            await self._dispatch_update(ej)
+            return
+
+        # Päivitys on jo jonossa, se lähettää lopulta uusimman staten
+        if ej in self._pending_update:
+            return
+
+        loop = asyncio.get_event_loop()
+        wait = self._last_update.get(ej, float("-inf")) + 1/self.max_rate - loop.time()
+
+        if wait <= 0:
+            await self._dispatch_update(ej)
+        else:
+            self._pending_update[ej] = loop.call_later(wait, self._flush_update, ej)
+
+    def _flush_update(self, ej):
+        del self._pending_update[ej]
+        asyncio.ensure_future(self._dispatch_update(ej))
+
+    async def _dispatch_update(self, ej):
+        self._last_update[ej] = asyncio.get_event_loop().time()
+
         async with self._update_lock:
+            # end on voinut ehtiä väliin, sen mukana menee jo viimeisin state
+            if ej not in self.all:
+                return
+
             await dispatch(self, "on_update", ej, is_active=ej==self.active)
 
     async def end(self, ej):
         if ej not in self.all:
             return
 
-        self.all.remove(ej)
+        self._remove(ej)
+        self._last_update.pop(ej, None)
+        pending = self._pending_update.pop(ej, None)
+        if pending is not None:
+            pending.cancel()
+
         was_active = ej == self.active
         if was_active:
             old_active = self.active
@@ -83,7 +149,7 @@ class EventFilter:
         async with self._update_lock:
             await dispatch(self, "on_end",
                     ej=ej,
-                    is_active=ej==old_active
+                    is_active=was_active
             )
 
             if was_active:
@@ -92,6 +158,12 @@ class EventFilter:
                         new_active=new_active
                 )
 
+    def _add(self, ej):
+        self.all.add(ej)
+
+    def _remove(self, ej):
+        self.all.remove(ej)
+
     def _maybe_update_active(self):
         old_active = self.active
         new_active = self.select_active(self.all)
@@ -107,24 +179,34 @@ class Judging:
     def __init__(self):
         self.active = {}
         self.filters = set()
+        # (kenttä, arvo) -> filtterit, jotka voivat täsmätä tuomarointiin jolla on se arvo
+        self._index = collections.defaultdict(set)
+        self._unindexed = set()
+        # Tuomaroinnin alussa selvitetyt filtterit, joille päivitykset menevät
+        self._routes = {}
 
     async def start(self, event, judge):
         if self.is_active(event.id, judge.id):
             raise JudgingError("Duplicate judging (%d, %d)" % (event.id, judge.id))
 
-        ej = EventJudging(event, judge)
+        # Tuomarointi ei koskaan pidä kiinni ORM-olioista
+        ej = EventJudging(snapshot_event(event), snapshot_judge(judge))
         self.active[event.id, judge.id] = ej
 
-        await asyncio.gather(*(f.start(ej) for f in self.filters))
+        candidates = list(self._candidates(ej))
+        accepted = await asyncio.gather(*(f.start(ej) for f in candidates))
+        self._routes[ej] = {f for f, a in zip(candidates, accepted) if a}
+
         return ej
 
-    async def update(self, ej, state):
+    async def update(self, ej, state, raw=None):
         ej.state = state
-        await asyncio.gather(*(f.update(ej) for f in self.filters))
+        ej.state_raw = raw
+        await asyncio.gather(*(f.update(ej) for f in self._routes[ej]))
 
     async def end(self, ej):
         del self.active[ej.event.id, ej.judge.id]
-        await asyncio.gather(*(f.end(ej) for f in self.filters))
+        await asyncio.gather(*(f.end(ej) for f in self._routes.pop(ej)))
 
     async def session(self, event, judge):
         ej = await self.start(event, judge)
@@ -135,25 +217,127 @@ class Judging:
 
     def add_filter(self, flt):
         self.filters.add(flt)
+
+        keys = flt.index_keys()
+        if keys is None:
+            self._unindexed.add(flt)
+        else:
+            for k in keys:
+                self._index[k].add(flt)
+
         flt.init(self.active.values())
+        for ej in flt.all:
+            self._routes[ej].add(flt)
 
     def remove_filter(self, flt):
         self.filters.remove(flt)
+        self._unindexed.discard(flt)
+
+        for k in flt.index_keys() or ():
+            self._index[k].discard(flt)
+            if not self._index[k]:
+                del self._index[k]
 
+        for route in self._routes.values():
+            route.discard(flt)
+
+    def _candidates(self, ej):
+        ret = set(self._unindexed)
+
+        for k in ej.route_keys():
+            if k in self._index:
+                ret.update(self._index[k])
+
+        return ret
+
+# Tuomarin viestit menevät postilaatikkoon, josta erillinen taski vie aina uusimman
+# tilan eteenpäin. Näin hidas fan-out ei jumita tuomarin websocketin lukemista.
 class JudgingSession:
 
+    on_overload = lazy_signal()
+
     def __init__(self, judging, ej):
         self.judging = judging
         self.ej = ej
-
-    async def update(self, state):
-        await self.judging.update(self.ej, state)
+        self.overloaded = False
+        self.stats = collections.Counter()
+        self.max_latency = 0
+        self._mailbox = None
+        self._wakeup = asyncio.Event()
+        self._closing = False
+        self._dispatcher = None
+        self._notify = AsyncJobQueue()
+
+    def put(self, state, raw=None):
+        if self._mailbox is not None:
+            # Edellistä ei ehditty lähettää, se korvataan uudella
+            self.stats["coalesced"] += 1
+            if not self.overloaded:
+                self.overloaded = True
+                self._notify(dispatch(self, "on_overload", overloaded=True))
+
+        self._mailbox = state, raw, asyncio.get_event_loop().time()
+        self._wakeup.set()
+
+    @property
+    def avg_latency(self):
+        if not self.stats["dispatched"]:
+            return 0
+        return self.stats["latency"] / self.stats["dispatched"]
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+
+            while self._mailbox is not None:
+                state, raw, ts = self._mailbox
+                self._mailbox = None
+
+                try:
+                    await self.judging.update(self.ej, state, raw)
+                except Exception:
+                    logger.exception("Failed to dispatch update for %s" % self.ej)
+
+                latency = loop.time() - ts
+                self.stats["dispatched"] += 1
+                self.stats["latency"] += latency
+                self.max_latency = max(self.max_latency, latency)
+
+            if self.overloaded:
+                self.overloaded = False
+                self._notify(dispatch(self, "on_overload", overloaded=False))
+
+            if self._closing:
+                return
+
+    async def _close(self):
+        self._closing = True
+        self._wakeup.set()
+        await self._dispatcher
+        await self.judging.end(self.ej)
 
     async def __aenter__(self):
+        self._dispatcher = asyncio.ensure_future(self._run())
         return self
 
     async def __aexit__(self, *args):
-        await asyncio.shield(self.judging.end(self.ej))
+        await asyncio.shield(self._close())
+
+# Palauttaa (state, raw), raw on None jos sitä ei voi liimata sellaisenaan SSE-frameen
+def parse_state(data):
+    state = loads(data)
+
+    if not isinstance(state, dict):
+        raise ValueError("Expected an object, got: %s" % type(state).__name__)
+
+    raw = data.strip()
+    if "\n" in raw or "\r" in raw:
+        raw = None
+
+    return state, raw
 
 class JudgingWebHandler:
 
@@ -161,14 +345,23 @@ class JudgingWebHandler:
         self.judging = judging
 
     def init(self, app):
-        app.add_routes([web.get(r"/judging/{event_id:\d+}", self.judging_ws)])
+        app.add_routes([
+            web.get(r"/judging/{event_id:\d+}", self.judging_ws),
+            web.get("/judging/stats", self.get_stats)
+        ])
         logger.info("Judging websocket available at /judging/<id>!")
 
+    async def get_stats(self, request):
+        return json_response({
+            "active": len(self.judging.active),
+            "robostat_db": {k: v.as_dict() for k,v in request.app["robostat-db"].stats.items()}
+        })
+
     async def judging_ws(self, request):
         event_id = int(request.match_info["event_id"])
         decoder = request.app["session-decoder"]
         session_cookie = request.app["session-cookie"]
-        robostat_db = request.app["robostat-db"]
+        catalog = request.app["catalog"]
 
         try:
             session = decoder(request.cookies[session_cookie])
@@ -180,31 +373,27 @@ class JudgingWebHandler:
         except:
             raise web.HTTPUnauthorized()
 
-        judge = robostat_db.query(model.Judge).filter_by(id=judge_id).first()
+        event, judge = catalog.get_judging(event_id, judge_id)
 
-        ej = robostat_db.query(model.EventJudging)\
-                .filter_by(event_id=event_id, judge_id=judge_id)\
-                .options(
-                        joinedload(model.EventJudging.event, innerjoin=True)
-                        .joinedload(model.Event.teams_part, innerjoin=True)
-                        .joinedload(model.EventTeam.team, innerjoin=True)
-                )\
-                .first()
+        if event is None:
+            # Tuomarointi on voitu lisätä kantaan viimeisimmän päivityksen jälkeen
+            await catalog.refresh()
+            event, judge = catalog.get_judging(event_id, judge_id)
 
-        if judge is None or ej is None:
+        if event is None:
             raise web.HTTPForbidden()
 
         try:
-            ses = await self.judging.session(ej.event, judge)
+            ses = await self.judging.session(event, judge)
         except JudgingError:
             raise web.HTTPBadRequest()
 
         logger = request_logger("%s:%d:%d" % (judge.name, judge.id, event_id))
         logger.start("Open judging id: %d | Block: %s | Scheduled at: %s | Teams: %s" % (
             event_id,
-            ej.event.block_id,
-            datetime.fromtimestamp(ej.event.ts_sched).strftime("%d.%m.%Y %H:%M"),
-            ", ".join("%s:%d" % (t.name, t.id) for t in ej.event.teams)
+            event.block_id,
+            datetime.fromtimestamp(event.ts_sched).strftime("%d.%m.%Y %H:%M"),
+            ", ".join("%s:%d" % (t.name, t.id) for t in event.teams)
         ))
 
         try:
@@ -212,11 +401,35 @@ class JudgingWebHandler:
                 ws = web.WebSocketResponse()
                 await ws.prepare(request)
 
+                async def notify_overload(overloaded):
+                    if overloaded:
+                        logger.warning("Fan-out can't keep up, coalescing updates")
+                    if not ws.closed:
+                        await ws.send_str(dumps({
+                            "event": "fantsu:overload",
+                            "overloaded": overloaded
+                        }))
+
+                ses.on_overload(notify_overload)
+
                 async for mes in ws:
-                    state = mes.json()
-                    logger.incoming(str(state))
-                    await ses.update(state)
+                    if mes.type != web.WSMsgType.TEXT:
+                        continue
+
+                    try:
+                        state, raw = parse_state(mes.data)
+                    except ValueError as e:
+                        logger.warning("Invalid state: %s" % e)
+                        continue
+
+                    logger.incoming(raw or str(state))
+                    ses.put(state, raw)
         finally:
-            logger.end("Judging closed")
+            logger.end("Judging closed | Updates: %d (%d coalesced) | Latency: avg %.1f ms, max %.1f ms" % (
+                ses.stats["dispatched"],
+                ses.stats["coalesced"],
+                1000*ses.avg_latency,
+                1000*ses.max_latency
+            ))
 
         return ws
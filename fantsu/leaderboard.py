@@ -0,0 +1,78 @@
+import bisect
+import os
+
+# sortedcontainers jos asennettu (O(log n) päivitykset), muuten bisectillä järjestetty lista.
+try:
+    from sortedcontainers import SortedList
+except ImportError:
+    SortedList = None
+
+class _BisectList:
+
+    def __init__(self):
+        self._items = []
+
+    def add(self, item):
+        bisect.insort(self._items, item)
+
+    def remove(self, item):
+        del self._items[bisect.bisect_left(self._items, item)]
+
+    def bisect_left(self, item):
+        return bisect.bisect_left(self._items, item)
+
+    def __getitem__(self, idx):
+        return self._items[idx]
+
+    def __len__(self):
+        return len(self._items)
+
+# Käyttäjät pistejärjestyksessä. Alkiot ovat (-points, id), joten rank on
+# itseä enemmän pisteitä omaavien määrä + 1 (tasapisteillä sama rank).
+class Leaderboard:
+
+    def __init__(self):
+        self._entries = SortedList() if SortedList is not None else _BisectList()
+        self._points = {}
+        # ETageja varten, ettei uudelleenkäynnistyksen jälkeen samasta versiosta tule 304
+        self.epoch = os.urandom(4).hex()
+        self.version = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def update(self, user):
+        old = self._points.get(user.id)
+        if old == user.points:
+            return
+
+        if old is not None:
+            self._entries.remove((-old, user.id))
+
+        self._entries.add((-user.points, user.id))
+        self._points[user.id] = user.points
+        self.version += 1
+
+    def update_many(self, users):
+        for user in users:
+            self.update(user)
+
+    def rank(self, id):
+        try:
+            points = self._points[id]
+        except KeyError:
+            return None
+
+        return self._entries.bisect_left((-points,)) + 1
+
+    # Listana (rank, id, points)
+    def top(self, n):
+        ret = []
+        rank = 0
+
+        for i, (points, id) in enumerate(self._entries[:n]):
+            if not ret or ret[-1][2] != -points:
+                rank = i + 1
+            ret.append((rank, id, -points))
+
+        return ret
@@ -0,0 +1,115 @@
+import time
+import sqlalchemy as sa
+import fantsu.db as model
+from fantsu.logging import logger
+
+# Bettauksen tapahtumat kirjoitetaan bet_ledger-tauluun UserManagerin flushien mukana.
+# Rivit (op):
+#   start      matsi alkoi
+#   countdown  countdown alkoi, amount = sekunnit
+#   place      käyttäjän betti (korvaa saman käyttäjän aiemman betin matsissa)
+#   cancel     matsi peruttiin
+#   payout     tilitetyn betin palautus (ret)
+#   settle     matsi tilitettiin, target = voittaja
+# Käynnistyessä auki jääneet matsit (start ilman perässä tulevaa cancel/settle-riviä)
+# rakennetaan uudelleen ja käyttäjien allokaatiot palautetaan niiden beteistä.
+class BetLedger:
+
+    def __init__(self, users):
+        self.users = users
+
+    def attach(self, betting):
+        betting.on_start(self._start)
+        betting.on_countdown_start(self._countdown_start)
+        betting.on_bets(self._bets)
+        betting.on_cancel(self._cancel)
+        betting.on_end(self._end)
+
+    def restore(self, betting, events):
+        table = model.BetLedgerEntry.__table__
+        start = time.perf_counter()
+
+        with self.users.engine.connect() as conn:
+            for event_id, start_id in self._open_matches(conn, table):
+                event = events.get(event_id)
+                if event is None:
+                    logger.warning("Can't restore match on unknown event eid=%s" % event_id)
+                    continue
+
+                bets = {}
+                countdown_end = None
+
+                for row in conn.execute(sa.select(table)
+                        .where(table.c.event_id == event_id)
+                        .where(table.c.id > start_id)
+                        .order_by(table.c.id)):
+                    if row.op == "place" and row.amount:
+                        bets[row.user_id] = row.target, row.amount
+                    elif row.op == "countdown":
+                        countdown_end = row.ts + row.amount
+
+                self._restore_match(betting, event, bets, countdown_end)
+
+        logger.info("Restored %d open matches from ledger (%.1f ms)" % (
+            len(betting.matches), 1000*(time.perf_counter()-start)))
+
+    def _open_matches(self, conn, table):
+        last = {}
+
+        for event_id, op, id in conn.execute(
+                sa.select(table.c.event_id, table.c.op, sa.func.max(table.c.id))
+                .where(table.c.op.in_(("start", "cancel", "settle")))
+                .group_by(table.c.event_id, table.c.op)):
+            last.setdefault(event_id, {})[op] = id
+
+        return [(event_id, ops["start"]) for event_id, ops in last.items()
+                if "start" in ops and ops["start"] > max(ops.get("cancel", 0), ops.get("settle", 0))]
+
+    def _restore_match(self, betting, event, bets, countdown_end):
+        restore = []
+
+        for user_id, (target, amount) in bets.items():
+            user = self.users.get(user_id)
+            if user is None:
+                logger.warning("Ledger has a bet from unknown user %s eid=%s" % (user_id, event.id))
+                continue
+            restore.append((user, target, amount))
+
+        countdown = countdown_end - time.time() if countdown_end is not None else None
+        betting.restore(event, restore, countdown=countdown)
+
+    def _append(self, rows):
+        self.users.append_ledger(rows)
+
+    def _row(self, event, op, user=None, target=None, amount=None, ret=None):
+        return {
+            "ts": time.time(),
+            "event_id": event.id,
+            "op": op,
+            "user_id": user.id if user is not None else None,
+            "target": target,
+            "amount": amount,
+            "ret": ret
+        }
+
+    def _start(self, match, event):
+        self._append([self._row(event, "start")])
+
+    def _countdown_start(self, match, event):
+        self._append([self._row(event, "countdown", amount=round(match.countdown_left))])
+
+    def _bets(self, match, event, bets):
+        self._append([self._row(event, "place", b.user, b.target, b.amount) for b in bets])
+
+    def _cancel(self, match, event):
+        self._append([self._row(event, "cancel")])
+
+    def _end(self, match, event, bets, winner):
+        # Pisteet merkitään tässä samaan erään settle-rivin kanssa. Muuten taustaflush
+        # voisi ehtiä kirjoittaa settlen ennen käyttäjien uusia pisteitä.
+        self.users.mark_dirty_many(b.user for b in bets.values())
+
+        rows = [self._row(event, "payout", b.user, b.target, b.amount, b.ret)
+                for b in bets.values()]
+        rows.append(self._row(event, "settle", target=winner))
+        self._append(rows)
@@ -1,193 +1,685 @@
 import asyncio
+import collections
 import json
+import os
+import weakref
+from urllib.parse import urlencode, parse_qsl
 from aiohttp import web
 from aiohttp_sse import sse_response
-from robostat.web.views.api import jsonify
 from fantsu.logging import logger, request_logger
+from fantsu.codec import dumps, loads, json_response
+from fantsu.util import merge_diff
+from fantsu.filters import spec_keys, normalize_spec, from_list as flt_from_list
+
+def encode_frame(event, data, id=None):
+    if id is None:
+        return ("event: %s\r\ndata: %s\r\n\r\n" % (event, data)).encode("utf-8")
+
+    return ("id: %s\r\nevent: %s\r\ndata: %s\r\n\r\n" % (id, event, data)).encode("utf-8")
+
+# Yksi lähetettävä eventti. Bytet enkoodataan vasta kun niitä ensimmäisen kerran
+# tarvitaan ja sen jälkeen samat bytet menevät kaikille clienteille.
+class Frame:
+
+    __slots__ = ("event", "data", "id", "seq", "active", "key", "delta", "_encoded", "_tagged")
+
+    def __init__(self, event, data, id=None, seq=None, active=True, key=None, delta=None):
+        self.event = event
+        self.data = data
+        self.id = id
+        self.seq = seq
+        self.active = active
+        self.key = key
+        self.delta = delta
+        self._encoded = None
+        self._tagged = None
+
+    @property
+    def size(self):
+        return len(self.data) + (self.delta.size if self.delta is not None else 0)
+
+    def encode(self):
+        if self._encoded is None:
+            self._encoded = encode_frame(self.event, self.data, id=self.id)
+        return self._encoded
+
+    # Multipleksatuille clienteille: data kääritään kanavan kanssa ja id jätetään pois,
+    # koska client laskee oman yhdistetyn id:n kaikista kanavistaan. Kanavan nimi on
+    # clienttikohtainen, joten bytet muistetaan per kanava.
+    def encode_tagged(self, channel):
+        if self._tagged is None:
+            self._tagged = {}
+
+        try:
+            return self._tagged[channel]
+        except KeyError:
+            ret = self._tagged[channel] = encode_frame(self.event,
+                    '{"channel":%s,"data":%s}' % (dumps(channel), self.data))
+            return ret
+
+OVERFLOW_POLICIES = ("drop-oldest", "coalesce", "disconnect")
+
+class SSEClient:
+
+    def __init__(self, resp, logger, stats, active_only=False, delta=False, multiplex=False,
+            maxsize=256, overflow="drop-oldest"):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Invalid overflow policy: %s (Expected one of: %s)" % (
+                overflow, OVERFLOW_POLICIES))
 
-class SSERelay:
-
-    def __init__(self, resp, logger):
         self.resp = resp
         self.logger = logger
+        self.stats = stats
+        self.active_only = active_only
+        self.delta = delta
+        self.multiplex = multiplex
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.closed = False
+        self._queue = collections.deque()
+        self._wakeup = asyncio.Event()
+        self._writer = None
+        # Avaimet joiden patcheja on pudotettu jonosta, näille pitää lähettää koko tila
+        self._stale = set()
+        # Multipleksatun clientin viimeisin id per kanava
+        self.last_ids = {}
+        # Kanavan nimi per hub. Ad-hoc-hubeja jaetaan clienttien kesken, joten nimi on
+        # clientin oma eikä hubin
+        self.channels = {}
+
+    def start(self):
+        self._writer = asyncio.ensure_future(self._run())
+
+    def close(self):
+        if self.closed:
+            return
+
+        self.closed = True
+        self._queue.clear()
+
+        if self._writer is not None:
+            self._writer.cancel()
+
+        self.resp.stop_streaming()
+
+    def push(self, frame, channel=None):
+        if self.closed or not self.accepts(frame):
+            return
+
+        key = self._key(frame, channel)
+
+        if len(self._queue) >= self.maxsize and not self._overflow(key):
+            return
+
+        self._queue.append((key, self._encode(frame, channel, key)))
+        self._wakeup.set()
+
+    def push_many(self, frames):
+        if self.closed:
+            return
+
+        data = b"".join(self._encode(f, c, self._key(f, c)) for f, c in frames if self.accepts(f))
+
+        if data:
+            self._queue.append((None, data))
+            self._wakeup.set()
 
-    async def __aenter__(self):
-        self._resp = await self.resp.__aenter__()
-        await self.init()
-        return self._resp
+    def accepts(self, frame):
+        return frame.active or not self.active_only
 
-    async def __aexit__(self, *args):
-        await self.deinit()
-        await self._resp.__aexit__()
-        del self._resp
+    def _key(self, frame, channel):
+        if frame.key is None or not self.multiplex:
+            return frame.key
+        return channel, frame.key
 
-    async def wait(self):
-        await self._resp.wait()
+    def _encode(self, frame, channel, key):
+        if self.delta and key is not None:
+            if frame.delta is not None and key not in self._stale:
+                frame = frame.delta
+            else:
+                self._stale.discard(key)
 
-    async def relay_event(self, name, data):
-        data = json.dumps(data)
-        self.logger.outgoing("event=%s | data=%s" % (name, data))
-        await self._resp.send(data, event=name)
+        if not self.multiplex:
+            return frame.encode()
 
-    async def init(self):
+        ret = frame.encode_tagged(channel)
+
+        if frame.id is not None:
+            self.last_ids[channel] = frame.id
+            ret = b"id: %s\r\n%s" % (urlencode(self.last_ids).encode("utf-8"), ret)
+
+        return ret
+
+    def _discard(self, i):
+        key, _ = self._queue[i]
+        del self._queue[i]
+        if self.delta and key is not None:
+            self._stale.add(key)
+
+    def _overflow(self, key):
+        if self.overflow == "disconnect":
+            self.stats["evicted"] += 1
+            self.logger.warning("Outbound queue full (%d frames), disconnecting slow client"\
+                    % len(self._queue))
+            self.close()
+            return False
+
+        if self.overflow == "coalesce" and key is not None:
+            for i, (k, _) in enumerate(self._queue):
+                if k == key:
+                    self._discard(i)
+                    self.stats["coalesced"] += 1
+                    return True
+
+        self._discard(0)
+        self.stats["dropped"] += 1
+        return True
+
+    async def _run(self):
+        try:
+            while True:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+
+                while self._queue:
+                    # Kaikki jonossa olevat framet yhdellä writellä
+                    frames = b"".join(f for _, f in self._queue)
+                    self._queue.clear()
+                    await self.resp.write(frames)
+                    self.stats["bytes_sent"] += len(frames)
+        except (ConnectionResetError, RuntimeError) as e:
+            self.logger.debug("Write failed: %s" % e)
+            self.close()
+
+# Hubi kuuntelee signaaleja vain kerran ja enkoodaa jokaisen eventin valmiiksi
+# SSE-frameksi, joka lähetetään sellaisenaan kaikille clienteille.
+# Lähetetyt framet jäävät rajatun kokoiseen historiaan, josta uudelleen yhdistävä
+# client saa Last-Event-ID:n perusteella pelkästään välistä puuttuvat eventit.
+class SSEHub:
+
+    def __init__(self, channel, history_size=1024, history_bytes=1<<20, linger=30):
+        self.channel = channel
+        self.clients = set()
+        self.stats = collections.Counter()
+        self.logger = request_logger("hub: %s" % channel)
+        self.history_size = history_size
+        self.history_bytes = history_bytes
+        self.linger = linger
+        self._history = collections.deque()
+        self._history_size = 0
+        self._subscribed = False
+        self._epoch = None
+        self._seq = 0
+        self._linger_handle = None
+
+    @property
+    def last_id(self):
+        return "%s-%d" % (self._epoch, self._seq)
+
+    @property
+    def subscribed(self):
+        return self._subscribed
+
+    def attach(self, client):
+        if self._linger_handle is not None:
+            self._linger_handle.cancel()
+            self._linger_handle = None
+
+        if not self._subscribed:
+            # Historia ei ole jatkumo edelliseen tilaukseen, joten uusi epookki
+            self._epoch = os.urandom(4).hex()
+            self._seq = 0
+            self._history.clear()
+            self._history_size = 0
+            self._subscribed = True
+            self.subscribe()
+
+        self.clients.add(client)
+
+    def detach(self, client):
+        self.clients.discard(client)
+
+        # Pidetään tilaus hetki auki, että uudelleen yhdistävä client saa historiasta
+        # puuttuvat eventit
+        if not self.clients and self._subscribed and self._linger_handle is None:
+            self._linger_handle = asyncio.get_event_loop().call_later(self.linger, self._expire)
+
+    def _expire(self):
+        self._linger_handle = None
+
+        if not self.clients:
+            self._subscribed = False
+            self._history.clear()
+            self._history_size = 0
+            self.unsubscribe()
+
+    def subscribe(self):
         pass
 
-    async def deinit(self):
+    def unsubscribe(self):
         pass
 
-class EventFilterRelay(SSERelay):
+    def snapshot(self, client):
+        return []
 
-    def __init__(self, resp, logger, flt, active_only):
-        super().__init__(resp, logger)
-        self._flt = flt
-        self._active_only = active_only
+    def init_frame(self, event, data):
+        return Frame(event, data, id=self.last_id, seq=self._seq)
+
+    def replay(self, client, last_event_id):
+        try:
+            epoch, seq = last_event_id.rsplit("-", 1)
+            seq = int(seq)
+        except ValueError:
+            return None
+
+        if epoch != self._epoch or seq > self._seq:
+            return None
+
+        if seq < self._seq and (not self._history or self._history[0].seq > seq+1):
+            return None
+
+        # Historia on järjestyksessä, joten riittää käydä läpi lopusta taaksepäin
+        ret = []
+        for f in reversed(self._history):
+            if f.seq <= seq:
+                break
+            ret.append(f)
+
+        ret.reverse()
+        self.stats["replayed"] += len(ret)
+        return ret
+
+    def broadcast(self, event, data, active=True, key=None, delta=None):
+        self._seq += 1
+        id = self.last_id
+
+        self.logger.outgoing("event=%s | id=%s | data=%s" % (event, id, data))
+
+        if delta is not None:
+            self.logger.outgoing("event=%s | id=%s | data=%s" % (delta[0], id, delta[1]))
+            delta = Frame(*delta, id=id, seq=self._seq, active=active, key=key)
+
+        frame = Frame(event, data, id=id, seq=self._seq, active=active, key=key, delta=delta)
+        self._remember(frame)
+
+        for c in self.clients:
+            c.push(frame, c.channels[self])
+
+    def _remember(self, frame):
+        self._history.append(frame)
+        self._history_size += frame.size
+
+        while len(self._history) > self.history_size\
+                or (self._history_size > self.history_bytes and len(self._history) > 1):
+            self._history_size -= self._history.popleft().size
+
+_ej_static = weakref.WeakKeyDictionary()
+
+def _jsonify_static_ej(ej):
+    try:
+        return _ej_static[ej]
+    except KeyError:
+        pass
 
-    async def init(self):
+    # Ilman aaltosulkeita, jotta tähän voi liimata perään staten
+    ret = dumps({
+        "event_id": ej.event.id,
+        "judge_id": ej.judge.id,
+        "block_id": ej.event.block_id,
+        "arena": ej.event.arena,
+        "ts_sched": ej.event.ts_sched,
+        "teams": [t.json for t in ej.event.teams]
+    })[1:-1]
+
+    _ej_static[ej] = ret
+    return ret
+
+# Tuomarin lähettämä validoitu json liimataan sellaisenaan jos se on tallessa
+def _jsonify_state(ej, state=None):
+    if state is None or state is ej.state:
+        if ej.state_raw is not None:
+            return ej.state_raw
+        state = ej.state
+
+    return dumps(state)
+
+def _jsonify_full_ej(ej, state=None):
+    if ej is None:
+        return "null"
+
+    return '{%s,"state":%s}' % (_jsonify_static_ej(ej), _jsonify_state(ej, state))
+
+def _jsonify_brief_ej(ej):
+    if ej is None:
+        return "null"
+
+    return '{"event_id":%d,"judge_id":%d,"state":%s}' % (
+            ej.event.id,
+            ej.judge.id,
+            _jsonify_state(ej)
+    )
+
+def _jsonify_patch_ej(ej, patch):
+    return '{"event_id":%d,"judge_id":%d,"patch":%s}' % (
+            ej.event.id,
+            ej.judge.id,
+            dumps(patch)
+    )
+
+class EventFilterHub(SSEHub):
+
+    def __init__(self, name, flt, delta_resync=50, **kwargs):
+        super().__init__("filter:%s" % name, **kwargs)
+        self._flt = flt
+        self._delta_resync = delta_resync
+        # Viimeisin lähetetty tila ja patchien määrä edellisestä kokonaisesta tilasta
+        self._states = {}
+        self._num_patches = {}
+        self._num_delta_clients = 0
+
+    def attach(self, client):
+        super().attach(client)
+        self._num_delta_clients += client.delta
+
+    def detach(self, client):
+        if client in self.clients:
+            self._num_delta_clients -= client.delta
+        super().detach(client)
+
+    def subscribe(self):
         self._flt.on_start(self._start)
         self._flt.on_switch_active(self._switch_active)
         self._flt.on_update(self._update)
         self._flt.on_end(self._end)
 
-        if self._active_only:
+    def unsubscribe(self):
+        del self._flt.on_start[self._start]
+        del self._flt.on_switch_active[self._switch_active]
+        del self._flt.on_update[self._update]
+        del self._flt.on_end[self._end]
+        self._states.clear()
+        self._num_patches.clear()
+
+    def snapshot(self, client):
+        if client.active_only:
             if self._flt.active is None:
-                return
+                return []
             ejs = [self._flt.active]
         else:
-            ejs = self._tl.all
+            ejs = self._flt.all
+
+        return [self.init_frame("judging:init", _jsonify_full_ej(ej, self._states.get(ej)))
+                for ej in ejs]
+
+    def _start(self, ej, is_active):
+        self._states[ej] = ej.state
+        self._num_patches[ej] = 0
+        self.broadcast("judging:start", _jsonify_full_ej(ej), active=is_active)
+
+    def _switch_active(self, old_active, new_active):
+        self.broadcast("judging:switch-active", '{"old":%s,"new":%s}' % (
+            _jsonify_full_ej(old_active, self._states.get(old_active)),
+            _jsonify_full_ej(new_active, self._states.get(new_active))
+        ))
+
+    def _update(self, ej, is_active):
+        self.broadcast("judging:update", _jsonify_brief_ej(ej), active=is_active,
+                key=(ej.event.id, ej.judge.id), delta=self._delta(ej))
+        self._states[ej] = ej.state
+
+    def _end(self, ej, is_active):
+        self._states.pop(ej, None)
+        self._num_patches.pop(ej, None)
+        self.broadcast("judging:end", _jsonify_brief_ej(ej), active=is_active)
+
+    def _delta(self, ej):
+        if not self._num_delta_clients:
+            return None
 
-        await asyncio.gather(*(self.relay_event("judging:init", self._jsonify_full_ej(ej))
-            for ej in ejs))
+        if ej not in self._states or self._num_patches[ej] >= self._delta_resync:
+            self._num_patches[ej] = 0
+            return None
 
-    async def deinit(self):
-        del self._flt.on_start[self._start]
-        del self._flt.on_switch_active[self._switch_active]
-        del self._flt.on_update[self._update]
-        del self._flt.on_end[self._end]
+        try:
+            patch = merge_diff(self._states[ej], ej.state)
+        except ValueError:
+            self._num_patches[ej] = 0
+            return None
 
-    async def _start(self, ej, is_active):
-        if is_active or not self._active_only:
-            await self.relay_event("judging:start", self._jsonify_full_ej(ej))
+        self._num_patches[ej] += 1
+        return "judging:patch", _jsonify_patch_ej(ej, patch)
 
-    async def _switch_active(self, old_active, new_active):
-        await self.relay_event("judging:switch-active", {
-            "old": self._jsonify_full_ej(old_active),
-            "new": self._jsonify_full_ej(new_active)
-        })
+class AdhocFilterHub(EventFilterHub):
 
-    async def _update(self, ej, is_active):
-        if is_active or not self._active_only:
-            await self.relay_event("judging:update", self._jsonify_brief_ej(ej))
+    def __init__(self, key, flt, registry, **kwargs):
+        super().__init__(key, flt, **kwargs)
+        self.key = key
+        self.flt = flt
+        self._registry = registry
 
-    async def _end(self, ej, is_active):
-        if is_active or not self._active_only:
-            await self.relay_event("judging:end", self._jsonify_brief_ej(ej))
+    def unsubscribe(self):
+        super().unsubscribe()
+        self._registry.release(self)
 
-    def _jsonify_full_ej(self, ej):
-        if ej is None:
-            return None
+# Clientien query stringissä antamat filtterit. Samat speksit jakavat saman filtterin,
+# joka poistetaan kun viimeinen kuuntelija lähtee.
+class AdhocFilters:
 
-        return {
-            "event_id": ej.event.id,
-            "judge_id": ej.judge.id,
-            "block_id": ej.event.block_id,
-            "arena": ej.event.arena,
-            "ts_sched": ej.event.ts_sched,
-            "teams": [jsonify(t) for t in ej.event.teams],
-            "state": ej.state
-        }
-
-    def _jsonify_brief_ej(self, ej):
-        if ej is None:
-            return None
+    def __init__(self, judging, flt_kwargs=None, hub_kwargs=None):
+        self.judging = judging
+        self.flt_kwargs = flt_kwargs or {}
+        self.hub_kwargs = hub_kwargs or {}
+        self.hubs = {}
+
+    def get(self, spec):
+        spec = normalize_spec(spec)
+        key = json.dumps(spec, sort_keys=True, separators=(",", ":"))
+
+        try:
+            return self.hubs[key]
+        except KeyError:
+            pass
+
+        flt = flt_from_list(spec, **self.flt_kwargs)
+        self.judging.add_filter(flt)
+        hub = self.hubs[key] = AdhocFilterHub(key, flt, self, **self.hub_kwargs)
+        _release_unused(self, hub, key)
+
+        logger.debug("Compiled ad-hoc filter %s" % key)
+        return hub
+
+    def release(self, hub):
+        del self.hubs[hub.key]
+        self.judging.remove_filter(hub.flt)
+
+        logger.debug("Removed ad-hoc filter %s" % hub.key)
 
-        return {
-            "event_id": ej.event.id,
-            "judge_id": ej.judge.id,
-            "state": ej.state
-        }
+# Hubia, jota ei koskaan attachata (pyyntö hylättiin tai sse_response kaatui), ei
+# myöskään vapauteta unsubscribessa. Vapautetaan se lingerin jälkeen jos kukaan ei tilannut.
+def _release_unused(registry, hub, key):
+    def release():
+        if not hub.subscribed and registry.hubs.get(key) is hub:
+            registry.release(hub)
 
-class BettingRelay(SSERelay):
+    asyncio.get_event_loop().call_later(hub.linger, release)
 
-    def __init__(self, resp, logger, betting):
-        super().__init__(resp, logger)
+def _jsonify_bet(bet):
+    ret = {
+        "display_name": bet.user.display_name,
+        "target": bet.target,
+        "amount": bet.amount
+    }
+
+    if bet.ret is not None:
+        ret["ret"] = bet.ret
+
+    return ret
+
+def _jsonify_bets(bets):
+    return list(map(_jsonify_bet, bets.values()))
+
+# Ilman event_id:tä kaikkien matsien eventit, muuten vain yhden eventin
+class BettingHub(SSEHub):
+
+    def __init__(self, betting, event_id=None, pool_interval=0.5, **kwargs):
+        super().__init__("betting" if event_id is None else "betting:%s" % event_id, **kwargs)
+        self.event_id = event_id
         self._betting = betting
+        self.pool_interval = pool_interval
+        self._pool_pending = set()
+        self._pool_handle = None
 
-    async def init(self):
+    def subscribe(self):
         self._betting.on_start(self._start)
         self._betting.on_countdown_start(self._countdown_start)
         self._betting.on_countdown_cancel(self._countdown_cancel)
-        self._betting.on_bet(self._bet)
+        self._betting.on_bets(self._bets)
         self._betting.on_countdown_end(self._countdown_end)
         self._betting.on_cancel(self._cancel)
         self._betting.on_end(self._end)
 
-        if self._betting.event is not None:
-            await self.relay_event("betting:init", {
-                "event_id": self._betting.event.id,
-                "countdown": self._betting.match.countdown_left
-            })
-
-    async def deinit(self):
+    def unsubscribe(self):
         del self._betting.on_start[self._start]
         del self._betting.on_countdown_start[self._countdown_start]
         del self._betting.on_countdown_cancel[self._countdown_cancel]
-        del self._betting.on_bet[self._bet]
+        del self._betting.on_bets[self._bets]
         del self._betting.on_countdown_end[self._countdown_end]
         del self._betting.on_cancel[self._cancel]
         del self._betting.on_end[self._end]
 
-    async def _start(self, match, event):
-        await self.relay_event("betting:start", {"event_id": event.id})
-
-    async def _countdown_start(self, match, event):
-        await self.relay_event("betting:countdown-start", {
-            "event_id": event.id,
-            "countdown": match.countdown_left
-        })
-
-    async def _countdown_cancel(self, match, event):
-        await self.relay_event("betting:countdown-cancel", {"event_id": event.id})
-
-    async def _bet(self, match, event, user, target, amount):
-        await self.relay_event("betting:bet", {
-            "event_id": event.id,
-            "display_name": user.display_name,
-            "target": target,
-            "amount": amount
-        })
-
-    async def _countdown_end(self, match, event):
-        await self.relay_event("betting:countdown-end", {
-            "event_id": event.id,
-            "bets": self._jsonify_bets(match.bets)
-        })
-
-    async def _cancel(self, match, event):
-        await self.relay_event("betting:cancel", {"event_id": event.id})
-
-    async def _end(self, match, event, bets, winner):
-        await self.relay_event("betting:end", {
-            "event_id": event.id,
-            "bets": self._jsonify_bets(bets),
-            "winner": winner
-        })
-
-    def _jsonify_bet(self, bet):
-        ret = {
-            "display_name": bet.user.display_name,
-            "target": bet.target,
-            "amount": bet.amount
-        }
-
-        if bet.ret is not None:
-            ret["ret"] = bet.ret
+        if self._pool_handle is not None:
+            self._pool_handle.cancel()
+            self._pool_handle = None
+            self._pool_pending.clear()
 
-        return ret
+    def snapshot(self, client):
+        ret = []
 
-    def _jsonify_bets(self, bets):
-        return list(map(self._jsonify_bet, bets.values()))
+        for match in self._matches():
+            ret.append(self.init_frame("betting:init", dumps({
+                "event_id": match.event.id,
+                "countdown": match.countdown_left
+            })))
+            ret.append(self.init_frame("betting:pool", dumps(self._betting.pool(match.event.id))))
 
-async def relay_sse(request, relay_class, logger_name=None, headers=None, **relay_kwargs):
+        return ret
+
+    def _matches(self):
+        if self.event_id is None:
+            return list(self._betting.matches.values())
+
+        match = self._betting.matches.get(self.event_id)
+        return [match] if match is not None else []
+
+    def _accepts(self, event):
+        return self.event_id is None or event.id == self.event_id
+
+    # Betit voivat tulla tuhansina, pottitilanne lähetetään korkeintaan kerran
+    # pool_intervalin aikana
+    def _schedule_pool(self, event):
+        self._pool_pending.add(event.id)
+
+        if self._pool_handle is None:
+            self._pool_handle = asyncio.get_event_loop().call_later(self.pool_interval,
+                    self._send_pool)
+
+    def _send_pool(self):
+        pending = self._pool_pending
+        self._pool_pending = set()
+        self._pool_handle = None
+
+        for event_id in pending:
+            if event_id in self._betting.matches:
+                self.broadcast("betting:pool", dumps(self._betting.pool(event_id)),
+                        key=("pool", event_id))
+
+    def _start(self, match, event):
+        if self._accepts(event):
+            self.broadcast("betting:start", dumps({"event_id": event.id}))
+
+    def _countdown_start(self, match, event):
+        if self._accepts(event):
+            self.broadcast("betting:countdown-start", dumps({
+                "event_id": event.id,
+                "countdown": match.countdown_left
+            }))
+
+    def _countdown_cancel(self, match, event):
+        if self._accepts(event):
+            self.broadcast("betting:countdown-cancel", dumps({"event_id": event.id}))
+
+    def _bets(self, match, event, bets):
+        if self._accepts(event):
+            self.broadcast("betting:bets", dumps({
+                "event_id": event.id,
+                "bets": list(map(_jsonify_bet, bets))
+            }))
+            self._schedule_pool(event)
+
+    def _countdown_end(self, match, event):
+        if self._accepts(event):
+            self.broadcast("betting:countdown-end", dumps({
+                "event_id": event.id,
+                "pool": match.pool(self._betting.basebet)
+            }))
+
+    def _cancel(self, match, event):
+        if self._accepts(event):
+            self.broadcast("betting:cancel", dumps({"event_id": event.id}))
+
+    def _end(self, match, event, bets, winner):
+        if self._accepts(event):
+            self.broadcast("betting:end", dumps({
+                "event_id": event.id,
+                "bets": _jsonify_bets(bets),
+                "winner": winner
+            }))
+
+class EventBettingHub(BettingHub):
+
+    def __init__(self, betting, event_id, registry, **kwargs):
+        super().__init__(betting, event_id=event_id, **kwargs)
+        self._registry = registry
+
+    def unsubscribe(self):
+        super().unsubscribe()
+        self._registry.release(self)
+
+# Yhden eventin betting-hubit luodaan ensimmäiselle kuuntelijalle ja poistetaan
+# kun viimeinen lähtee.
+class BettingHubs:
+
+    def __init__(self, betting, hub_kwargs=None):
+        self.betting = betting
+        self.hub_kwargs = hub_kwargs or {}
+        self.hubs = {}
+
+    def get(self, event_id):
+        try:
+            return self.hubs[event_id]
+        except KeyError:
+            pass
+
+        hub = self.hubs[event_id] = EventBettingHub(self.betting, event_id, self,
+                **self.hub_kwargs)
+        _release_unused(self, hub, event_id)
+        return hub
+
+    def release(self, hub):
+        del self.hubs[hub.event_id]
+
+def _init_frames(client, hub, last_event_id):
+    if last_event_id is not None:
+        ret = hub.replay(client, last_event_id)
+        if ret is not None:
+            return ret
+        client.logger.debug("Can't resume %s from %s, sending snapshot" % (
+            hub.channel, last_event_id))
+
+    return hub.snapshot(client)
+
+async def relay_sse(request, hubs, logger_name=None, headers=None, multiplex=False,
+        channels=None, **client_kwargs):
     if logger_name is None:
         logger_name = "SSE: %s" % request.rel_url
 
@@ -198,43 +690,177 @@ async def relay_sse(request, relay_class, logger_name=None, headers=None, **rela
 
     headers.setdefault("Access-Control-Allow-Origin", "*")
 
-    relay = relay_class(
-            resp=sse_response(request, headers=headers),
-            logger=logger,
-            **relay_kwargs
-    )
-
-    async with relay as resp:
-        logger.start("Relaying events on %s" % request.url)
-        await relay.wait()
-        logger.end("Stop relaying events on %s" % request.url)
+    for k, v in request.app["relay-client-opts"].items():
+        client_kwargs.setdefault(k, v)
+
+    if channels is None:
+        channels = [h.channel for h in hubs]
+
+    last_event_id = request.headers.get("Last-Event-ID", request.query.get("last_event_id"))
+    if multiplex and last_event_id is not None:
+        last_event_ids = dict(parse_qsl(last_event_id))
+    else:
+        last_event_ids = dict.fromkeys(channels, last_event_id)
+
+    async with sse_response(request, headers=headers) as resp:
+        client = SSEClient(resp, logger, request.app["relay-stats"], multiplex=multiplex,
+                **client_kwargs)
+
+        # Attach ja snapshot jonon alkuun ilman awaitia välissä,
+        # ettei välistä putoa eventtejä. Kaikkien kanavien init menee samalla writellä.
+        init = []
+        for hub, channel in zip(hubs, channels):
+            client.channels[hub] = channel
+            hub.attach(client)
+            client.last_ids[channel] = hub.last_id
+            init.extend((f, channel) for f in _init_frames(client, hub,
+                last_event_ids.get(channel)))
+
+        client.push_many(init)
+        client.start()
+
+        try:
+            logger.start("Relaying events on %s" % request.url)
+            await resp.wait()
+        finally:
+            for hub in hubs:
+                hub.detach(client)
+            client.close()
+            logger.end("Stop relaying events on %s" % request.url)
 
     return resp
 
+def _query_flag(request, name):
+    return request.query.get(name, "0") not in ("0", "false")
+
+def _query_specs(request):
+    if "spec" in request.query:
+        return [loads(spec) for spec in request.query.getall("spec")]
+
+    spec = {k: request.query.getall(k) for k in spec_keys if k in request.query}
+    return [spec] if spec else []
+
+def _adhoc_specs(request):
+    try:
+        return [normalize_spec(spec) for spec in _query_specs(request)]
+    except ValueError as e:
+        raise web.HTTPBadRequest(text=str(e))
+
 async def filter_sse(request):
     name = request.match_info["name"]
 
     try:
-        flt = request.app["filters"][name]
+        hub = request.app["filter-hubs"][name]
     except KeyError:
         raise web.HTTPNotFound()
 
-    return await relay_sse(request,
-            relay_class=EventFilterRelay,
-            flt=flt,
-            active_only=True
+    return await relay_sse(request, [hub],
+            active_only=not _query_flag(request, "all"),
+            delta=_query_flag(request, "delta")
+    )
+
+async def adhoc_filter_sse(request):
+    specs = _adhoc_specs(request)
+
+    if len(specs) != 1:
+        raise web.HTTPBadRequest()
+
+    return await relay_sse(request, [request.app["adhoc-filters"].get(specs[0])],
+            active_only=not _query_flag(request, "all"),
+            delta=_query_flag(request, "delta")
     )
 
 async def betting_sse(request):
-    return await relay_sse(request,
-            relay_class=BettingRelay,
-            betting=request.app["betting"]
+    return await relay_sse(request, [request.app["betting-hub"]])
+
+async def event_betting_sse(request):
+    try:
+        event_id = int(request.match_info["event_id"])
+    except ValueError:
+        raise web.HTTPNotFound()
+
+    return await relay_sse(request, [request.app["betting-hubs"].get(event_id)])
+
+async def stream_sse(request):
+    hubs = []
+
+    # Kaikki parametrit tarkistetaan ennen kuin ad-hoc- tai betting-hubeja luodaan
+    try:
+        for name in request.query.getall("filter", []):
+            hubs.append(request.app["filter-hubs"][name])
+        if _query_flag(request, "betting"):
+            hubs.append(request.app["betting-hub"])
+        event_ids = [int(event_id) for event_id in request.query.getall("betting_event", [])]
+        if event_ids and "betting-hubs" not in request.app:
+            raise KeyError("betting-hubs")
+    except KeyError:
+        raise web.HTTPNotFound()
+    except ValueError:
+        raise web.HTTPBadRequest()
+
+    specs = _adhoc_specs(request)
+
+    if not (hubs or event_ids or specs):
+        raise web.HTTPBadRequest()
+
+    if any(spec in specs[:i] for i, spec in enumerate(specs)):
+        raise web.HTTPBadRequest(text="Duplicate filter spec")
+
+    hubs.extend(request.app["betting-hubs"].get(event_id) for event_id in event_ids)
+    channels = [h.channel for h in hubs]
+
+    # Ad-hoc-kanavat nimetään speksin järjestysnumerolla (spec:0, spec:1, ...), koska
+    # client ei tiedä normalisoitua speksiä. Normalisoitu JSON on vain hubien avain.
+    for i, spec in enumerate(specs):
+        hubs.append(request.app["adhoc-filters"].get(spec))
+        channels.append("spec:%d" % i)
+
+    return await relay_sse(request, hubs,
+            channels=channels,
+            multiplex=True,
+            active_only=not _query_flag(request, "all"),
+            delta=_query_flag(request, "delta")
     )
 
-def init_relay(app):
-    app.add_routes([web.get("/filter/{name}", filter_sse)])
+async def relay_stats(request):
+    hubs = list(request.app["filter-hubs"].values())
+    hubs.extend(request.app["adhoc-filters"].hubs.values())
+    if "betting-hub" in request.app:
+        hubs.append(request.app["betting-hub"])
+        hubs.extend(request.app["betting-hubs"].hubs.values())
+
+    return json_response({
+        "clients": dict(request.app["relay-stats"]),
+        "hubs": {h.channel: dict(h.stats, clients=len(h.clients)) for h in hubs}
+    })
+
+def init_relay(app, queue_size=256, overflow="drop-oldest", delta_resync=50, pool_interval=0.5,
+        **hub_kwargs):
+    app["relay-client-opts"] = {"maxsize": queue_size, "overflow": overflow}
+    app["relay-stats"] = collections.Counter()
+
+    app["filter-hubs"] = {name: EventFilterHub(name, flt, delta_resync=delta_resync, **hub_kwargs)
+            for name, flt in app.get("filters", {}).items()}
+    app["adhoc-filters"] = AdhocFilters(app["judging"],
+            flt_kwargs=app.get("filter-opts"),
+            hub_kwargs=dict(hub_kwargs, delta_resync=delta_resync)
+    )
 
-    if "betting" in app:
-        app.add_routes([web.get("/betting/events", betting_sse)])
+    app.add_routes([
+        web.get("/filter", adhoc_filter_sse),
+        web.get("/filter/{name}", filter_sse),
+        web.get("/stream", stream_sse),
+        web.get("/relay/stats", relay_stats)
+    ])
 
-    logger.info("Relay active!")
+    if "betting" in app:
+        app["betting-hub"] = BettingHub(app["betting"], pool_interval=pool_interval,
+                **hub_kwargs)
+        app["betting-hubs"] = BettingHubs(app["betting"],
+                hub_kwargs=dict(hub_kwargs, pool_interval=pool_interval))
+        app.add_routes([
+            web.get("/betting/events", betting_sse),
+            web.get("/betting/events/{event_id}", event_betting_sse)
+        ])
+
+    logger.info("Relay active! (queue size: %d, overflow: %s)" % (queue_size, overflow))
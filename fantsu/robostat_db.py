@@ -0,0 +1,81 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy.orm import sessionmaker
+from fantsu.logging import logger
+
+class QueryStats:
+
+    __slots__ = ("count", "total", "max")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, elapsed):
+        self.count += 1
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "avg_ms": 1000*self.total/self.count if self.count else 0,
+            "max_ms": 1000*self.max
+        }
+
+# Robostatin kanta luetaan rajatussa threadpoolissa, jokaisella workerilla oma yhteys
+# ja jokaisella kyselyllä oma sessio. Event looppi ei koskaan odota sqlitea.
+class RobostatDB:
+
+    def __init__(self, engine, max_workers=4, slow_query=0.1):
+        self.engine = engine
+        self.slow_query = slow_query
+        self.stats = {}
+        self._sessionmaker = sessionmaker()
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(
+                max_workers=max_workers,
+                thread_name_prefix="robostat-db"
+        )
+
+    async def run(self, f, *args):
+        loop = asyncio.get_event_loop()
+        queued = time.perf_counter()
+        ret, elapsed = await loop.run_in_executor(self._executor, self._run, f, args)
+        waited = time.perf_counter() - queued - elapsed
+
+        name = f.__name__
+        if name not in self.stats:
+            self.stats[name] = QueryStats()
+        self.stats[name].record(elapsed)
+
+        if elapsed > self.slow_query:
+            logger.warning("Slow robostat query %s: %.1f ms (queued %.1f ms)" % (
+                name, 1000*elapsed, 1000*waited))
+
+        return ret
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    def _connection(self):
+        conn = getattr(self._local, "connection", None)
+
+        if conn is None:
+            conn = self._local.connection = self.engine.connect()
+
+        return conn
+
+    def _run(self, f, args):
+        start = time.perf_counter()
+        session = self._sessionmaker(bind=self._connection())
+
+        try:
+            return f(session, *args), time.perf_counter() - start
+        finally:
+            # Palautetut oliot jäävät irrallisiksi, joten kyselyn pitää ladata kaikki
+            # mitä niistä käytetään
+            session.close()
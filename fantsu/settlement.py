@@ -0,0 +1,75 @@
+import heapq
+from array import array
+
+# Tilitys rinnakkaisilla taulukoilla: numpy jos asennettu, muuten array-moduuli.
+# Kaikki laskenta kokonaisluvuilla, joten pisteitä ei synny eikä katoa pyöristyksessä.
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# numpy-polku laskee int64:llä, isommat tulot lasketaan python-inteillä
+_int64_max = (1 << 63) - 1
+
+def asarray(values):
+    if np is not None:
+        return np.fromiter(values, dtype=np.int64)
+
+    return array("q", values)
+
+# Jakaa potin voittaneille panosten suhteessa. Osuudet pyöristetään alaspäin ja loput
+# pisteet jaetaan suurimman jakojäännöksen mukaan (tasatilanteessa aiemmin tullut ensin),
+# joten palautusten summa on tasan pool. Jos kukaan ei voittanut, palautukset ovat nollia.
+def settle(amounts, won, pool):
+    if np is not None:
+        amounts = np.asarray(amounts, dtype=np.int64)
+        stakes = np.where(np.asarray(won, dtype=bool), amounts, 0)
+
+        if len(stakes) == 0 or pool * int(stakes.max()) <= _int64_max:
+            return _settle_np(stakes, pool)
+
+        stakes = stakes.tolist()
+    else:
+        stakes = [a if w else 0 for a, w in zip(amounts, won)]
+
+    return asarray(_settle_py(stakes, pool))
+
+def _settle_np(stakes, pool):
+    total_win = int(stakes.sum())
+    if total_win == 0:
+        return np.zeros_like(stakes)
+
+    ret, rem = np.divmod(stakes * pool, total_win)
+    left = pool - int(ret.sum())
+
+    if left > 0:
+        ret[np.argsort(-rem, kind="stable")[:left]] += 1
+
+    return ret
+
+def _settle_py(stakes, pool):
+    total_win = sum(stakes)
+    if total_win == 0:
+        return [0] * len(stakes)
+
+    ret, rem = [], []
+    for s in stakes:
+        q, r = divmod(s * pool, total_win)
+        ret.append(q)
+        rem.append(r)
+
+    left = pool - sum(ret)
+
+    if left > 0:
+        for i in heapq.nlargest(left, range(len(rem)), key=rem.__getitem__):
+            ret[i] += 1
+
+    return ret
+
+# Uudet pistesaldot: max(points + returns - amounts, min_points)
+def payout(points, amounts, returns, min_points=0):
+    if np is not None:
+        ret = np.asarray(points, dtype=np.int64) + returns - amounts
+        return np.maximum(ret, min_points)
+
+    return array("q", (max(p + r - a, min_points) for p, a, r in zip(points, amounts, returns)))
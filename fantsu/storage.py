@@ -0,0 +1,92 @@
+import contextlib
+import sqlalchemy as sa
+from sqlalchemy.event import listens_for
+from fantsu.logging import logger
+
+# synchronous=NORMAL on WAL-tilassa turvallinen: kaatuminen voi hukata viimeisimmät
+# commitit mutta ei korruptoi kantaa. Bettauksen tulokset flushataan erikseen.
+storage_profiles = {
+    "default": {
+        "journal_mode": "wal",
+        "synchronous": "normal",
+        "mmap_size": 64 << 20,
+        "cache_size": -16000,
+        "busy_timeout": 5000,
+        "cached_statements": 256
+    },
+    "durable": {
+        "journal_mode": "wal",
+        "synchronous": "full",
+        "mmap_size": 64 << 20,
+        "cache_size": -16000,
+        "busy_timeout": 5000,
+        "cached_statements": 256
+    },
+    "fast": {
+        "journal_mode": "wal",
+        "synchronous": "off",
+        "mmap_size": 256 << 20,
+        "cache_size": -64000,
+        "busy_timeout": 5000,
+        "cached_statements": 256
+    },
+    "legacy": {
+        "journal_mode": "delete",
+        "synchronous": "full",
+        "mmap_size": 0,
+        "cache_size": -2000,
+        "busy_timeout": 0,
+        "cached_statements": 100
+    }
+}
+
+pragmas = ("journal_mode", "synchronous", "mmap_size", "cache_size", "busy_timeout")
+
+_synchronous = {0: "off", 1: "normal", 2: "full", 3: "extra"}
+
+def get_profile(profile):
+    if isinstance(profile, str):
+        try:
+            return storage_profiles[profile]
+        except KeyError:
+            raise ValueError("Invalid storage profile: %s (Expected one of: %s)" % (
+                profile, list(storage_profiles)))
+
+    return dict(storage_profiles["default"], **profile)
+
+def create_engine(path, profile="default"):
+    profile = get_profile(profile)
+
+    engine = sa.create_engine("sqlite:///%s" % path,
+            connect_args={"cached_statements": profile["cached_statements"]})
+
+    @listens_for(engine, "connect")
+    def configure(connection, record):
+        with contextlib.closing(connection.cursor()) as cursor:
+            for p in pragmas:
+                cursor.execute("PRAGMA %s=%s;" % (p, profile[p]))
+
+    return engine
+
+def read_pragmas(engine):
+    ret = {}
+
+    with engine.connect() as conn:
+        for p in pragmas:
+            ret[p] = conn.exec_driver_sql("PRAGMA %s;" % p).scalar()
+
+    ret["synchronous"] = _synchronous.get(ret["synchronous"], ret["synchronous"])
+    return ret
+
+def check_pragmas(engine, profile="default"):
+    profile = get_profile(profile)
+    effective = read_pragmas(engine)
+
+    logger.info("SQLite storage profile: %s" % ", ".join("%s=%s" % kv for kv in effective.items()))
+
+    for p in pragmas:
+        if str(effective[p]).lower() != str(profile[p]).lower():
+            logger.warning("PRAGMA %s did not take effect (wanted %s, got %s)" % (
+                p, profile[p], effective[p]))
+
+    return effective
@@ -1,29 +1,177 @@
+import asyncio
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import bindparam
 import fantsu.db as model
+from fantsu.logging import logger
+from fantsu.leaderboard import Leaderboard
 from fantsu.util import lazy_signal, dispatch
 
+# Käyttäjät pidetään muistissa ja muutokset kirjoitetaan kantaan taustalla isommissa
+# erissä. flush() kirjoittaa kaiken odottavan ja palaa vasta kun commit on tehty.
+# Bettien lokirivit (fantsu.ledger) kirjoitetaan samassa transaktiossa käyttäjien kanssa,
+# joten kanta on aina joko ennen tai jälkeen tilityksen.
 class UserManager:
 
-    on_create_user = lazy_signal()
+    on_create_users = lazy_signal()
 
-    def __init__(self, app):
+    def __init__(self, app, flush_interval=1, flush_size=100):
         self.app = app
         self.db = app["fantsu-db"]
+        self.engine = self.db.get_bind()
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.users = {}
+        self.leaderboard = Leaderboard()
+        self._new = set()
+        self._dirty = set()
+        self._ledger = []
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._full = asyncio.Event()
+        self._flusher = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fantsu-db")
 
-    def commit(self):
-        self.db.commit()
+    def load(self):
+        for user in self.db.query(model.User).all():
+            self.users[user.id] = user
+
+        self.leaderboard.update_many(self.users.values())
+
+        # Oliot irti sessiosta, kirjoitukset tehdään flushissa suoraan tauluun
+        self.db.expunge_all()
+        logger.info("Loaded %d users" % len(self.users))
+
+    def start(self):
+        self._flusher = asyncio.ensure_future(self._run())
+
+    async def close(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+
+        await self.flush()
+        self._executor.shutdown(wait=True)
 
     def get(self, id):
-        return self.db.query(model.User).get(id)
+        return self.users.get(id)
 
-    async def get_or_create(self, id, display_name, commit=True):
+    async def get_or_create(self, id, display_name):
         user = self.get(id)
 
         if user is None:
-            user = model.User(id=id, display_name=display_name)
-            await dispatch(self, "on_create_user", user=user)
-            self.db.add(user)
-            if commit:
-                self.db.commit()
+            user, = await self.get_or_create_many([(id, display_name)])
 
         return user
+
+    async def get_or_create_many(self, users):
+        ret = []
+        new = {}
+
+        for id, display_name in users:
+            user = self.users.get(id) or new.get(id)
+            if user is None:
+                user = new[id] = model.User(id=id, display_name=display_name)
+            ret.append(user)
+
+        if new:
+            await dispatch(self, "on_create_users", users=list(new.values()))
+            self.users.update(new)
+            self.leaderboard.update_many(new.values())
+            self._new.update(new)
+            self._schedule()
+
+        return ret
+
+    # Kaikki pistemuutokset kulkevat tämän kautta, joten leaderboard päivitetään tässä
+    def mark_dirty_many(self, users):
+        users = list(users)
+        self.leaderboard.update_many(users)
+        self._dirty.update(user.id for user in users if user.id not in self._new)
+        self._schedule()
+
+    def append_ledger(self, rows):
+        self._ledger.extend(rows)
+        self._schedule()
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._new and not self._dirty and not self._ledger:
+                return
+
+            new, dirty, ledger = self._new, self._dirty, self._ledger
+            self._new, self._dirty, self._ledger = set(), set(), []
+
+            insert = [self._row(self.users[id], "id") for id in new]
+            update = [self._row(self.users[id], "_id") for id in dirty]
+
+            start = time.perf_counter()
+
+            fut = asyncio.get_event_loop().run_in_executor(self._executor, self._write,
+                    insert, update, ledger)
+
+            # Peruutus ei pysäytä säiettä, joten erä odotetaan loppuun lukon sisällä ja
+            # palautetaan jonoon vain jos itse kirjoitus epäonnistui
+            try:
+                await asyncio.shield(fut)
+            except asyncio.CancelledError:
+                await asyncio.wait([fut])
+                raise
+            finally:
+                if fut.done() and fut.exception() is not None:
+                    self._new |= new
+                    self._dirty |= dirty - self._new
+                    self._ledger[:0] = ledger
+
+            logger.debug("Flushed users: %d new, %d updated, %d ledger rows (%.1f ms)" % (
+                len(insert), len(update), len(ledger), 1000*(time.perf_counter()-start)))
+
+    def _schedule(self):
+        self._wakeup.set()
+
+        # Täysi erä herättää flusherin heti, flushaus tehdään silti vain flusherissa
+        if len(self._new) + len(self._dirty) + len(self._ledger) >= self.flush_size:
+            self._full.set()
+
+    def _row(self, user, id_key):
+        return {
+            id_key: user.id,
+            "display_name": user.display_name,
+            "points": user.points
+        }
+
+    def _write(self, insert, update, ledger):
+        table = model.User.__table__
+
+        with self.engine.begin() as conn:
+            if insert:
+                conn.execute(table.insert(), insert)
+            if update:
+                conn.execute(
+                        table.update()
+                        .where(table.c.id == bindparam("_id"))
+                        .values(display_name=bindparam("display_name"), points=bindparam("points")),
+                        update
+                )
+            if ledger:
+                conn.execute(model.BetLedgerEntry.__table__.insert(), ledger)
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            # Odotetaan hetki, että samaan committiin ehtii kertyä muutoksia
+            try:
+                await asyncio.wait_for(self._full.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            self._full.clear()
+
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Failed to flush users")
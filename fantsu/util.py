@@ -1,28 +1,74 @@
 import asyncio
 import collections
+import inspect
+import time
 from fantsu.logging import logger
 
+# Kuuntelijat dictissä (järjestetty joukko), joten lisäys ja poisto ovat O(1).
+# Tavalliset funktiot kutsutaan suoraan ilman taskeja, vain korutiineja odotetaan
+# (rinnakkain jos niitä on useampi). Yksittäisen kuuntelijan virhe tai timeout
+# logataan eikä näy dispatchin kutsujalle.
 class AsyncSignal:
 
-    def __init__(self):
-        self.listeners = []
+    def __init__(self, timeout=None):
+        self.listeners = {}
+        self.timeout = timeout
 
     def __call__(self, f):
-        self.listeners.append(f)
+        self.listeners[f] = None
 
     def __delitem__(self, f):
-        self.listeners.remove(f)
+        del self.listeners[f]
+
+    def __len__(self):
+        return len(self.listeners)
 
     async def dispatch(self, *args, **kwargs):
-        return await asyncio.gather(*(l(*args, **kwargs) for l in self.listeners))
+        pending = []
+
+        # Kopio, koska kuuntelija voi poistaa itsensä kesken dispatchin
+        for l in tuple(self.listeners):
+            try:
+                ret = l(*args, **kwargs)
+            except Exception:
+                logger.exception("Signal listener %s failed" % l)
+                continue
+
+            if ret is not None and (asyncio.iscoroutine(ret) or inspect.isawaitable(ret)):
+                pending.append((l, ret))
+
+        if len(pending) == 1:
+            await self._wait(*pending[0])
+        elif pending and self.timeout is None:
+            # Ei ylimääräistä käärettä per kuuntelija, virheet kerätään gatherilla
+            results = await asyncio.gather(*(aw for _, aw in pending), return_exceptions=True)
+            for (l, _), r in zip(pending, results):
+                if isinstance(r, Exception):
+                    logger.error("Signal listener %s failed" % l, exc_info=r)
+        elif pending:
+            await asyncio.gather(*(self._wait(l, aw) for l, aw in pending))
+
+    async def _wait(self, listener, aw):
+        try:
+            if self.timeout is None:
+                await aw
+            else:
+                await asyncio.wait_for(aw, self.timeout)
+        except asyncio.TimeoutError:
+            logger.error("Signal listener %s timed out after %s s" % (listener, self.timeout))
+        except Exception:
+            logger.exception("Signal listener %s failed" % listener)
 
 class AsyncLazySignalProperty:
 
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+
     def __set_name__(self, cls, name):
         self.name = name
 
     def __get__(self, obj, cls):
-        ret = AsyncSignal()
+        ret = AsyncSignal(timeout=self.timeout)
         setattr(obj, self.name, ret)
         return ret
 
@@ -44,7 +90,73 @@ class AsyncJobQueue:
         if self._fut is None or self._fut.done(): # Tää rimmaa aika hyvin
             self._fut = asyncio.ensure_future(self._step())
 
+    async def join(self):
+        while self._fut is not None and not self._fut.done():
+            await asyncio.shield(self._fut)
+
     async def _step(self):
         while self._queue:
             coro = self._queue.popleft()
             await coro
+
+# Token bucket per avain. Muistissa korkeintaan max_keys bucketia, vanhimmat
+# heitetään pois (ja saavat palatessaan täyden bucketin). rate=None -> ei rajaa.
+class RateLimiter:
+
+    def __init__(self, rate, burst, max_keys=100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = collections.OrderedDict()
+
+    def allow(self, key=None, cost=1):
+        if self.rate is None:
+            return True
+
+        now = time.monotonic()
+
+        try:
+            tokens, ts = self._buckets.pop(key)
+            tokens = min(self.burst, tokens + (now - ts) * self.rate)
+        except KeyError:
+            tokens = self.burst
+            if len(self._buckets) >= self.max_keys:
+                self._buckets.popitem(last=False)
+
+        allowed = tokens >= cost
+        if allowed:
+            tokens -= cost
+
+        self._buckets[key] = tokens, now
+        return allowed
+
+def _check_no_nulls(value):
+    if isinstance(value, dict):
+        for v in value.values():
+            if v is None:
+                raise ValueError("null can't be expressed in a merge patch")
+            _check_no_nulls(v)
+
+# JSON merge patch (RFC 7396), jolla päästään tilasta old tilaan new.
+# Heittää ValueErrorin jos sellaista ei ole (null-arvot), silloin pitää lähettää koko tila
+def merge_diff(old, new):
+    if not isinstance(old, dict) or not isinstance(new, dict):
+        if new is None:
+            raise ValueError("null can't be expressed in a merge patch")
+        _check_no_nulls(new)
+        return new
+
+    ret = dict.fromkeys(old.keys() - new.keys())
+
+    for k, v in new.items():
+        if k in old:
+            if old[k] == v:
+                continue
+            ret[k] = merge_diff(old[k], v)
+        else:
+            if v is None:
+                raise ValueError("null can't be expressed in a merge patch")
+            _check_no_nulls(v)
+            ret[k] = v
+
+    return ret
@@ -1,4 +1,4 @@
-import {judge} from "./client.js";
+import {judge, mes} from "./client.js";
 import {InfoBox} from "./ui.js";
 
 class Relay {
@@ -35,7 +35,8 @@ class Relay {
 			event: opt.event,
 			onOpen: () => this._handleOpen(),
 			onClose: () => this._handleClose(),
-			onError: () => this._handleError()
+			onError: () => this._handleError(),
+			[mes("fantsu:overload")]: ({overloaded}) => this.box.setOverloaded(overloaded)
 		});
 	}
 
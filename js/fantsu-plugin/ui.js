@@ -54,6 +54,11 @@ export class InfoBox {
 			disconnect));
 	}
 
+	setOverloaded(overloaded){
+		this.$root.classList.toggle("rssserv-overloaded", overloaded);
+		this.$root.title = overloaded ? "Palvelin ruuhkautunut, päivityksiä yhdistetään" : "";
+	}
+
 	setError(){
 		// näköjään tää ei anna mitään error stringiä
 		// lol javascript
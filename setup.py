@@ -12,5 +12,8 @@ setup(
             "sqlalchemy",
             "aiohttp",
             "aiohttp_sse"
-        ]
+        ],
+        extras_require = {
+            "fast": ["orjson", "numpy", "sortedcontainers"]
+        }
 )
@@ -12,3 +12,24 @@ export default function listen(url, events){
 
 	return ret;
 }
+
+export function stream(url, channels){
+	const ret = new EventSource(url);
+	const names = new Set();
+
+	for(let events of Object.values(channels)){
+		for(let name of Object.keys(events))
+			names.add(name);
+	}
+
+	for(let name of names){
+		ret.addEventListener(name, evt => {
+			const {channel, data} = JSON.parse(evt.data);
+			const events = channels[channel];
+			if(events && events[name])
+				events[name](data, name);
+		});
+	}
+
+	return ret;
+}